@@ -3,6 +3,17 @@
 # -*- coding: utf-8 -*-
 import os
 import logging
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import requests
+import ujson
+from requests.adapters import HTTPAdapter
 from aplos.categories.category import Category, CategoryKey
 from aplos.insights.entity_capability import EntityCapability
 from aplos.lib.tenant.tenant_utils import TenantUtils
@@ -10,9 +21,9 @@ from aplos.lib.tenant.tenant_utils import TenantUtils
 from calm.common.config import init_config, get_config
 from calm.common.flags import gflags
 from calm.common.project_util import ProjectUtil
-from calm.lib.model import Application, Account
+from calm.lib.model import Application, Account, NutanixPCAccount
 from calm.lib.constants import SUBSTRATE
-from calm.lib.model.store.idf.db import create_db_connection
+from calm.lib.model.store.idf.db import create_db_connection, get_insights_db
 from calm.lib.model.store.db_session import create_session, set_session_type
 from calm.pkg.common.scramble import init_scramble
 
@@ -36,21 +47,497 @@ def guardrail_save(obj, dry_run, description=""):
         obj.save()
         log.info("Saved object: %s", description)
 
+PC_PORT = 9440
+PC_POOL_SIZE = int(os.environ.get("PC_POOL_SIZE", "20"))
+# Number of writes grouped in one v3 batch request, 0 disables batch mode
+PC_BATCH_SIZE = int(os.environ.get("PC_BATCH_SIZE", "0"))
+PC_MAX_CONCURRENCY = int(os.environ.get("PC_MAX_CONCURRENCY", PC_POOL_SIZE))
+PC_MAX_RETRIES = int(os.environ.get("PC_MAX_RETRIES", "5"))
+PC_BACKOFF_BASE = float(os.environ.get("PC_BACKOFF_BASE", "0.5"))
+PC_BACKOFF_MAX = float(os.environ.get("PC_BACKOFF_MAX", "30"))
+PC_REQUEST_TIMEOUT = float(os.environ.get("PC_REQUEST_TIMEOUT", "60"))
+PC_CIRCUIT_THRESHOLD = int(os.environ.get("PC_CIRCUIT_THRESHOLD", "10"))
+PC_CIRCUIT_COOLDOWN = float(os.environ.get("PC_CIRCUIT_COOLDOWN", "30"))
+IDF_PAGE_SIZE = int(os.environ.get("IDF_PAGE_SIZE", "1000"))
+PROJECT_CHANGE_CONCURRENCY = int(os.environ.get("PROJECT_CHANGE_CONCURRENCY", "4"))
+REMOTE_VM_CONCURRENCY = int(os.environ.get("REMOTE_VM_CONCURRENCY", "10"))
+# Times a remote VM PUT rejected for a stale spec_version (409) is retried with a fresh GET
+REMOTE_VM_CONFLICT_RETRIES = int(os.environ.get("REMOTE_VM_CONFLICT_RETRIES", "3"))
+# Responses that mean the PC is overloaded or briefly unavailable, these are retried
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+class AdaptiveLimiter(object):
+    """
+    AIMD concurrency limiter for calls to one PC.
+    The limit grows by about one per window of successful calls and is halved when the PC
+    throttles (at most once per second, so a burst of 429s counts as one signal).
+    """
+
+    def __init__(self, maximum=PC_MAX_CONCURRENCY, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def set_maximum(self, maximum):
+        """Lower or raise the ceiling, e.g. to a process's share of PC_MAX_CONCURRENCY"""
+        with self.cond:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.limit, float(self.maximum))
+            self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.time()
+            if throttled:
+                if now - self.last_decrease >= 1:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+                    log.warning("PC is throttling, concurrency limit lowered to %d", int(self.limit))
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive failed calls. While open every caller waits for the
+    cooldown instead of hitting the PC; afterwards calls go through again and the next failure
+    re-opens the circuit right away, a success closes it.
+    """
+
+    def __init__(self, threshold=PC_CIRCUIT_THRESHOLD, cooldown=PC_CIRCUIT_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            remaining = self.opened_at + self.cooldown - time.time() if self.opened_at else 0
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def record(self, ok):
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None or time.time() - self.opened_at >= self.cooldown:
+                    log.warning("%d consecutive PC call failures, pausing calls for %ss", self.failures, self.cooldown)
+                self.opened_at = time.time()
+
+
+def get_retry_after(response):
+    """Retry-After header in seconds, None if absent or not in seconds"""
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class PCClient(object):
+    """
+    Pooled, keep-alive client for Prism Central v3 API.
+    A single requests session is shared by every call so TCP/TLS connections to
+    the PC are reused for the whole run instead of being set up per request.
+    Calls are gated by an adaptive concurrency limiter and a circuit breaker, and
+    throttled/unavailable responses and connection errors are retried with backoff.
+    """
+
+    def __init__(self, pc_ip, username, password, port=PC_PORT, pool_size=PC_POOL_SIZE):
+        self.pc_ip = pc_ip
+        self.base_url = "https://{}:{}/api/nutanix/v3".format(pc_ip, port)
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({'content-type': 'application/json', 'Accept': 'application/json'})
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.limiter = AdaptiveLimiter()
+        self.breaker = CircuitBreaker()
+        self.retries = 0
+        self.throttled = 0
+
+    def request(self, method, path, payload=None):
+        """
+        Issue a request against the v3 API
+        Args:
+            method(str): HTTP method
+            path(str): path relative to /api/nutanix/v3, e.g. "/vms/<uuid>"
+            payload(dict): optional json body
+        Returns:
+            object: requests.Response, the last one if retries ran out
+        Raises:
+            requests.RequestException: when the last attempt failed to connect
+        """
+        attempt = 0
+        while True:
+            self.breaker.wait()
+            self.limiter.acquire()
+            response = None
+            error = None
+            try:
+                response = self.session.request(method, self.base_url + path, json=payload, timeout=PC_REQUEST_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                throttled = error is not None or (response is not None and response.status_code in THROTTLE_STATUS_CODES)
+                self.limiter.release(throttled=throttled)
+            failed = error is not None or response.status_code in RETRY_STATUS_CODES
+            self.breaker.record(not failed)
+            if not failed:
+                return response
+            if throttled:
+                self.throttled += 1
+            if attempt >= PC_MAX_RETRIES:
+                if error is not None:
+                    raise error
+                return response
+            delay = get_retry_after(response)
+            if delay is None:
+                # exponential backoff with full jitter
+                delay = random.uniform(0, min(PC_BACKOFF_MAX, PC_BACKOFF_BASE * 2 ** attempt))
+            log.info("%s %s failed (%s), retry %d/%d in %.1fs", method, path,
+                     error or response.status_code, attempt + 1, PC_MAX_RETRIES, delay)
+            attempt += 1
+            self.retries += 1
+            time.sleep(delay)
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, payload=None):
+        return self.request('POST', path, payload)
+
+    def put(self, path, payload=None):
+        return self.request('PUT', path, payload)
+
+
+def v3_path(*segments):
+    """Path relative to /api/nutanix/v3 built from raw segments, e.g. category values, each one URL encoded"""
+    return "".join("/" + quote(str(segment), safe="") for segment in segments)
+
+
+def batch_requests(client, api_requests, batch_size=PC_BATCH_SIZE):
+    """
+    Send requests through v3 batch API, batch_size requests per POST /batch
+    Args:
+        client(PCClient): client of the PC
+        api_requests(list): (operation, path, body) tuples, path relative to /api/nutanix/v3
+                            and URL encoded (see v3_path)
+        batch_size(int): requests per batch
+    Returns:
+        list: (status_code, response_body) per request, in request order. status_code is None
+              when the whole batch failed or the request got no response
+    """
+    results = []
+    for offset in range(0, len(api_requests), batch_size):
+        chunk = api_requests[offset:offset + batch_size]
+        payload = {
+            "action_on_failure": "CONTINUE",
+            "execution_order": "NON_SEQUENTIAL",
+            "api_version": "3.0",
+            "api_request_list": [
+                {"operation": operation, "path_and_params": "/api/nutanix/v3" + path, "body": body}
+                for operation, path, body in chunk
+            ]
+        }
+        response = client.post("/batch", payload)
+        if not response.ok:
+            log.info("Response status code {}, respnse content {}".format(response.status_code, response.content))
+            results.extend((None, response.content) for _ in chunk)
+            continue
+        # NON_SEQUENTIAL responses may come back in any order, match them to requests by path
+        chunk_results = [(None, None)] * len(chunk)
+        indexes_by_path = {}
+        for idx, (_, path, _) in enumerate(chunk):
+            indexes_by_path.setdefault(unquote("/api/nutanix/v3" + path), []).append(idx)
+        for api_response in response.json().get("api_response_list", []):
+            indexes = indexes_by_path.get(unquote(str(api_response.get("path_and_params"))))
+            if not indexes:
+                log.info("Ignoring batch response for unknown path '{}'".format(api_response.get("path_and_params")))
+                continue
+            # status comes back as a string, e.g. "200" or "202 Accepted"
+            try:
+                status_code = int(str(api_response.get("status")).split()[0])
+            except ValueError:
+                status_code = None
+            chunk_results[indexes.pop(0)] = (status_code, api_response.get("api_response"))
+        results.extend(chunk_results)
+    return results
+
+
+_pc_clients = {}
+_pc_clients_lock = threading.Lock()
+
+
+def get_pc_client(pc_ip, username, password):
+    """
+    Get shared PCClient for given PC, one client (and connection pool) per PC and user
+    Args:
+        pc_ip(str): PC ip
+        username(str): PC username
+        password(str): PC password
+    Returns:
+        object: PCClient
+    """
+    with _pc_clients_lock:
+        key = (pc_ip, username)
+        client = _pc_clients.get(key)
+        if client is None:
+            client = PCClient(pc_ip, username, password)
+            _pc_clients[key] = client
+        return client
+
+
+class LRUCache(object):
+    """
+    Bounded, thread safe LRU cache with hit/miss/eviction counters.
+    get returns None on a miss, so None values should not be stored.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return "{} hits, {} misses, {} evictions".format(self.hits, self.misses, self.evictions)
+
+
+class WriteBehind(object):
+    """
+    Write-behind layer for Calm model objects.
+    Modified objects are marked instead of saved, save_all saves each marked object once
+    (in the order it was first marked) and is meant to run right before flush_session().
+    Each mark records the owners (e.g. VM uuids) the object was modified for, so a failed
+    save can be traced back to them.
+    """
+
+    def __init__(self):
+        self.dirty = OrderedDict()
+        self.marked = 0
+        self.saved = 0
+        self.failed = 0
+
+    def mark(self, obj, owners=()):
+        self.marked += 1
+        if id(obj) not in self.dirty:
+            self.dirty[id(obj)] = (obj, set())
+        self.dirty[id(obj)][1].update(owners)
+
+    def save_all(self):
+        """Save the marked objects, returns the owners of the objects that failed to save"""
+        dirty, self.dirty = self.dirty, OrderedDict()
+        failed_owners = set()
+        for obj, owners in dirty.values():
+            try:
+                obj.save()
+                self.saved += 1
+            except Exception as e:
+                self.failed += 1
+                failed_owners.update(owners)
+                log.warning("Failed to save %s '%s': %s", type(obj).__name__, getattr(obj, "uuid", None), e)
+        return failed_owners
+
+    @property
+    def avoided(self):
+        """Saves avoided by coalescing repeated marks of the same object"""
+        return self.marked - self.saved - self.failed - len(self.dirty)
+
+
 init_config()
 
 # This is needed as when we import calm models, Flags needs be initialized
 
 
-def init_contexts():
-    """initiate context"""
+def init_contexts(flush_parallelisation_factor=None, bulk_size=None):
+    """
+    initiate context
+    Args:
+        flush_parallelisation_factor: green session flush parallelism, defaults to
+            CALM_FLUSH_PARALLELISATION_FACTOR env or the Calm store config
+        bulk_size: green session bulk size, defaults to CALM_BULK_SIZE env or the Calm store config
+    """
     cfg = get_config()
     keyfile = cfg.get('security', 'keyfile')
     init_scramble(keyfile)
-    set_session_type('green', cfg.get('store', 'flush_parallelisation_factor'), cfg.get('store', 'bulk_size'))
+    cfg_flush_parallelisation_factor = cfg.get('store', 'flush_parallelisation_factor')
+    cfg_bulk_size = cfg.get('store', 'bulk_size')
+    if flush_parallelisation_factor is None:
+        flush_parallelisation_factor = os.environ.get("CALM_FLUSH_PARALLELISATION_FACTOR")
+    if bulk_size is None:
+        bulk_size = os.environ.get("CALM_BULK_SIZE")
+    # Overrides are passed in the same type the Calm config hands out
+    flush_parallelisation_factor = cfg_flush_parallelisation_factor if flush_parallelisation_factor is None else type(cfg_flush_parallelisation_factor)(flush_parallelisation_factor)
+    bulk_size = cfg_bulk_size if bulk_size is None else type(cfg_bulk_size)(bulk_size)
+    log.info("Using green session with flush_parallelisation_factor %s, bulk_size %s", flush_parallelisation_factor, bulk_size)
+    set_session_type('green', flush_parallelisation_factor, bulk_size)
     create_db_connection(register_entities=False)
     create_session()
 
 
+def fetch_projection(proto, select, page_size=IDF_PAGE_SIZE, **filters):
+    """
+    Page through an IDF projection with get_insights_db().fetch_many, page_size rows per call.
+    Only the selected attributes are read, no model object is built.
+    Args:
+        proto(class): IDF entity proto, e.g. AbacEntityCapability
+        select(list): attribute names to read
+        page_size(int): rows per fetch_many call
+        filters: equality filters passed on to fetch_many
+    Returns:
+        generator: (uuid, [selected attribute values]) per entity
+    """
+    db_handle = get_insights_db()
+    offset = 0
+    while True:
+        rows = list(db_handle.fetch_many(proto, select=select, limit=page_size, offset=offset, **filters))
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        offset += page_size
+
+
+class AccountIndex(object):
+    """
+    Run scoped index of Nutanix accounts, built once from NutanixPCAccount.query(deleted=False):
+    PC server -> PC account, PC server -> {cluster_uuid: PE account uuid} and PE account uuid -> PC account.
+    Accounts not found in the index are fetched with Account.get_object and cached.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.accounts = {}
+        self.pc_account_by_server = {}
+        self.pe_account_uuid_by_cluster = {}
+        self.pc_account_by_pe = {}
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            for pc_account in NutanixPCAccount.query(deleted=False):
+                self.accounts[str(pc_account.uuid)] = pc_account
+                self.pc_account_by_server[pc_account.data.server] = pc_account
+                clusters = self.pe_account_uuid_by_cluster.setdefault(pc_account.data.server, {})
+                for pe in pc_account.data.nutanix_account:
+                    clusters[pe.data.cluster_uuid] = str(pe.uuid)
+                    self.pc_account_by_pe[str(pe.uuid)] = pc_account
+            self.loaded = True
+            log.info("Indexed %d PC accounts with %d PE accounts", len(self.pc_account_by_server), len(self.pc_account_by_pe))
+
+    def get_account(self, account_uuid):
+        self.load()
+        account_uuid = str(account_uuid)
+        account = self.accounts.get(account_uuid)
+        if account is None:
+            account = Account.get_object(account_uuid)
+            self.accounts[account_uuid] = account
+        return account
+
+    def get_pc_account(self, server):
+        self.load()
+        return self.pc_account_by_server.get(server)
+
+    def get_cluster_account_map(self, server):
+        """{cluster_uuid: PE account uuid} of the PC account with given server, None if there is no such account"""
+        self.load()
+        return self.pe_account_uuid_by_cluster.get(server)
+
+    def get_pc_account_for_pe(self, pe_account_uuid):
+        self.load()
+        pe_account_uuid = str(pe_account_uuid)
+        pc_account = self.pc_account_by_pe.get(pe_account_uuid)
+        if pc_account is None:
+            pc_account = self.get_account(self.get_account(pe_account_uuid).data.pc_account_uuid)
+            self.pc_account_by_pe[pe_account_uuid] = pc_account
+        return pc_account
+
+
+account_index = AccountIndex()
+
+
+class ProjectChangeContext(object):
+    """
+    Lookups shared by every application moved to one project: tenant, project proto and the
+    Project category of the project. Accounts come from the run scoped account_index.
+    """
+
+    def __init__(self, new_project_name):
+        self.tenant_uuid = TenantUtils.get_logged_in_tenant()
+        self.new_project_name = new_project_name
+
+        # Verify if supplied project name is valid
+        self.project_proto = ProjectUtil().get_project_by_name(new_project_name)
+        if not self.project_proto:
+            raise Exception("No project in system with name '{}'".format(new_project_name))
+        self.new_project_uuid = str(self.project_proto.uuid)
+
+        # Category with key 'Project' and value as new_project_name, same for every entity moved
+        self.category_uuid = str(get_or_create_category("Project", new_project_name, self.tenant_uuid).uuid)
+
+
+def resolve_application(application):
+    """
+    Get application by uuid or name
+    Raises:
+        Exception: when there is no such application
+    """
+    try:
+        uuid.UUID(str(application))
+    except ValueError:
+        # Verify if supplied application name is valid
+        apps = Application.query(name=application, deleted=False)
+        if not apps:
+            raise Exception("No app in system with name '{}'".format(application))
+        return apps[0]
+    app = Application.get_object(str(application))
+    if not app:
+        raise Exception("No app in system with uuid '{}'".format(application))
+    return app
+
+
 def change_project(application_name, new_project_name):
     """
     change_project method for the file
@@ -59,24 +546,61 @@ def change_project(application_name, new_project_name):
     Returns:
         None
     """
-    tenant_uuid = TenantUtils.get_logged_in_tenant()
-    project_handle = ProjectUtil()
-    app_name = application_name
-    new_project_name = new_project_name
+    move_application(resolve_application(application_name), ProjectChangeContext(new_project_name))
 
-    app_kind = "app"
 
-    # Verify if supplied project name is valid
-    project_proto = project_handle.get_project_by_name(new_project_name)
-    if not project_proto:
-        raise Exception("No project in system with name '{}'".format(new_project_name))
-    new_project_uuid = str(project_proto.uuid)
+def change_projects(applications, new_project_name, concurrency=PROJECT_CHANGE_CONCURRENCY):
+    """
+    Move many applications to one project. Tenant, project and Project category are resolved once
+    and shared. Store work runs serially on the calling thread, only the remote PC VM updates of
+    applications run in the background, at most concurrency applications at a time.
+    Args:
+        applications(list): application names or uuids
+        new_project_name(str): destination project name
+        concurrency(int): max applications whose remote PC VMs are updated in parallel
+    Raises:
+        Exception: when some application could not be moved, after all others are processed
+    """
+    context = ProjectChangeContext(new_project_name)
+    failed = []
+    remote_updates = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for application in applications:
+            try:
+                future = move_application(resolve_application(application), context, executor)
+                if future is not None:
+                    remote_updates.append((application, future))
+            except Exception as e:
+                log.warning("Failed to move application '%s' to project '%s': %s", application, new_project_name, e)
+                failed.append(application)
+        for application, future in remote_updates:
+            try:
+                future.result()
+            except Exception as e:
+                log.warning("Failed to move VMs of application '%s' to project '%s': %s", application, new_project_name, e)
+                failed.append(application)
+    if failed:
+        raise Exception("Failed to move applications {} to project '{}'".format(failed, new_project_name))
 
-    # Verify if supplied application name is valid
-    apps = Application.query(name=app_name, deleted=False)
-    if not apps:
-        raise Exception("No app in system with name '{}'".format(app_name))
-    app = apps[0]
+
+def move_application(app, context, remote_executor=None):
+    """
+    Move an application and its VMs to the context's project
+    Args:
+        app(object): Application
+        context(ProjectChangeContext): destination project lookups
+        remote_executor(ThreadPoolExecutor): when given, VMs on a remote PC are updated through it
+    Returns:
+        Future of the remote PC VM update when it was handed to remote_executor, otherwise None
+    """
+    tenant_uuid = context.tenant_uuid
+    category_uuid = context.category_uuid
+    app_name = app.name
+    new_project_name = context.new_project_name
+    project_proto = context.project_proto
+    new_project_uuid = context.new_project_uuid
+
+    app_kind = "app"
 
     entity_cap = EntityCapability(kind_name=app_kind, kind_id=str(app.uuid))
 
@@ -97,10 +621,10 @@ def change_project(application_name, new_project_name):
     pc_account_uuid_object_map = {}
     pe_account_pc_account_uuid_map = {}
     for pe_account_uuid in pe_account_uuids:
-        pe_account = Account.get_object(str(pe_account_uuid))
-        pc_account_uuid = str(pe_account.data.pc_account_uuid)
+        pc_account = account_index.get_pc_account_for_pe(pe_account_uuid)
+        pc_account_uuid = str(pc_account.uuid)
         pe_account_pc_account_uuid_map[str(pe_account_uuid)] = pc_account_uuid
-        pc_account_uuid_object_map[pc_account_uuid] = Account.get_object(str(pc_account_uuid))
+        pc_account_uuid_object_map[pc_account_uuid] = pc_account
 
     #for pc_account_uuid in pc_account_uuid_object_map:
         #if str(pc_account_uuid) not in project_proto.account_id_list:
@@ -139,14 +663,15 @@ def change_project(application_name, new_project_name):
 
     # Step 1 to 3 are needed as API's populate project_reference under metadata based Project Category
 
-    handle_entity_project_change("app", str(app.uuid), tenant_uuid, new_project_name, new_project_uuid)
+    handle_entity_project_change("app", str(app.uuid), tenant_uuid, new_project_name, new_project_uuid, category_uuid)
     log.info("Successfully changed '{}' application's ownership to new project '{}'".format(app_name, new_project_name))
     log.info("**" * 30)
     log.info("Now moving '{}' app's VM to new project '{}'".format(app_name, new_project_name))
 
     if app.app_blueprint_config.source_marketplace_name:
         log.info("Moving Markeplace BP of application '{}' to '{}' project".format(app_name, new_project_name))
-        handle_entity_project_change("blueprint", str(app.app_blueprint_config.uuid), tenant_uuid, new_project_name, new_project_uuid)
+        handle_entity_project_change("blueprint", str(app.app_blueprint_config.uuid), tenant_uuid, new_project_name,
+                                     new_project_uuid, category_uuid)
         log.info("Successfully moved Markeplace BP of application '{}' to '{}' project".format(app_name, new_project_name))
 
     if not pc_account_uuid_object_map:
@@ -173,19 +698,22 @@ def change_project(application_name, new_project_name):
 
     # Change ownership of all vm's to New project
     # Same step mentioned for app need to follow for vm
-    for vm_uuid in vm_uuids:
 
-        # Based on whether vm reside on local pc or remote pc we need to take action here
+    # Based on whether vm reside on local pc or remote pc we need to take action here
 
-        # 1. for remote pc vm, we needd to update CalmProject category to hold new project name as value
-        # 2. For local pc vm, we need to update vm's EC to point to new project, for local pc vm we don't
-        # see CalmProject, hence there is no need to update CalmProject category value
-        if is_app_remote_pc:
-            update_vm_in_remote_pc(pc_ip, pc_username, password, vm_uuid, new_project_name)
-            log.info("Successfully updated remote pc  '{}' vm's categories to hold new project name".format(vm_uuid))
-        else:
-            handle_entity_project_change("vm", vm_uuid, tenant_uuid, new_project_name, new_project_uuid)
-            log.info("Successfully moved '{}' vm which is part of '{}' application to new project '{}'".format(vm_uuid, app_name, new_project_name))
+    # 1. for remote pc vm, we needd to update CalmProject category to hold new project name as value
+    # 2. For local pc vm, we need to update vm's EC to point to new project, for local pc vm we don't
+    # see CalmProject, hence there is no need to update CalmProject category value
+    if is_app_remote_pc and remote_executor is not None:
+        # Only PC HTTP calls from here on, no store access
+        log.info("Updating remote pc vm's of '{}' application in background".format(app_name))
+        return remote_executor.submit(update_vms_in_remote_pc, pc_ip, pc_username, password, vm_uuids, new_project_name)
+    if is_app_remote_pc:
+        update_vms_in_remote_pc(pc_ip, pc_username, password, vm_uuids, new_project_name)
+    else:
+        change_entities_project([("vm", vm_uuid) for vm_uuid in vm_uuids], tenant_uuid, new_project_name, new_project_uuid,
+                                category_uuid)
+        log.info("Successfully moved vm's '{}' which are part of '{}' application to new project '{}'".format(vm_uuids, app_name, new_project_name))
     log.info("Successfully moved all vm's of '{}' application to '{}' project".format(app_name, new_project_name))
     log.info("Successfully moved '{}' application to  '{}' project ".format(app_name, new_project_name))
 
@@ -245,15 +773,47 @@ def change_project_vmware(application_name, new_project_name):
                 vm_uuids.append(str(sub_el.instance_id))
     # Change ownership of all vm's to New project
     # Same step mentioned for app need to follow for vm
-    for vm_uuid in vm_uuids:
-        handle_entity_project_change("vm", vm_uuid, tenant_uuid, new_project_name, new_project_uuid)
-        log.info("Successfully moved '{}' vm which is part of '{}' application to new project '{}'".format(vm_uuid, app_name, new_project_name))
+    change_entities_project([("vm", vm_uuid) for vm_uuid in vm_uuids], tenant_uuid, new_project_name, new_project_uuid)
+    log.info("Successfully moved vm's '{}' which are part of '{}' application to new project '{}'".format(vm_uuids, app_name, new_project_name))
     log.info("Successfully moved all vm's of '{}' application to '{}' project".format(app_name, new_project_name))
     log.info("Successfully moved '{}' application to  '{}' project ".format(app_name, new_project_name))
 
 DRY_RUN = os.environ.get("DRY_RUN", "false").lower() == "true"
 
-def handle_entity_project_change(entity_kind, entity_uuid, tenant_uuid, new_project_name, new_project_uuid):
+
+class CategoryKeyIndex(object):
+    """
+    Run scoped category uuid -> category key name index, filled lazily.
+    Key names are also cached by key uuid, so every Category and CategoryKey is read once per run
+    no matter how many entities carry it.
+    """
+
+    def __init__(self):
+        self.key_name_by_category = {}
+        self.name_by_key = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key_name(self, category_uuid):
+        category_uuid = str(category_uuid)
+        name = self.key_name_by_category.get(category_uuid)
+        if name is not None:
+            self.hits += 1
+            return name
+        self.misses += 1
+        key_uuid = str(Category(uuid=category_uuid).abac_category_key)
+        name = self.name_by_key.get(key_uuid)
+        if name is None:
+            name = CategoryKey(uuid=key_uuid).name
+            self.name_by_key[key_uuid] = name
+        self.key_name_by_category[category_uuid] = name
+        return name
+
+
+category_key_index = CategoryKeyIndex()
+
+
+def handle_entity_project_change(entity_kind, entity_uuid, tenant_uuid, new_project_name, new_project_uuid, new_category_uuid=None):
     """
     Handles entity project change
     Args:
@@ -262,34 +822,54 @@ def handle_entity_project_change(entity_kind, entity_uuid, tenant_uuid, new_proj
         tenant_uuid(str): Tenent uuid
         new_project_name(str): new project's name for the entity
         new_project_uuid(str): new project's uuid for the entity
+        new_category_uuid(str): uuid of the new Project category, looked up when not given
     """
+    change_entities_project([(entity_kind, entity_uuid)], tenant_uuid, new_project_name, new_project_uuid, new_category_uuid)
 
-    # 1. Find category uuid  corresponding to entity's EC for {"Project", "old project name"} category
-    entity_cap = EntityCapability(kind_name=entity_kind, kind_id=str(entity_uuid))
-    project_category_uuid = None
-    for c_uuid in entity_cap.category_id_list:
-        category_obj = Category(uuid=c_uuid)
-        project_category_key_uuid = str(category_obj.abac_category_key)
-        category_key_obj = CategoryKey(uuid=project_category_key_uuid)
-        if category_key_obj.name == "Project":
-            project_category_uuid = str(c_uuid)
-            break
 
-    # 2. Then remove category uuid found in step 1 from EC's category_id_list attribute
-    entity_cap.remove_categories([project_category_uuid])
+def change_entities_project(kind_uuid_pairs, tenant_uuid, new_project_name, new_project_uuid, new_category_uuid=None):
+    """
+    Handles project change of several entities that move to the same project.
+    The new Project category is looked up once and shared, each entity capability is still read,
+    updated and saved on its own since aplos EntityCapability loads and saves one entity at a time.
+    Args:
+        kind_uuid_pairs(list): (entity kind, entity uuid) tuples
+        tenant_uuid(str): Tenent uuid
+        new_project_name(str): new project's name for the entities
+        new_project_uuid(str): new project's uuid for the entities
+        new_category_uuid(str): uuid of the new Project category, looked up when not given
+    """
+    if not kind_uuid_pairs:
+        return
 
-    # 3. Create a New category with key 'Project' and value as new_project_name and then add category uuid to EC's category_id_list attribute
-    category_obj = get_or_create_category("Project", new_project_name, tenant_uuid)
-    entity_cap.add_categories([str(category_obj.uuid)])
+    # Category with key 'Project' and value as new_project_name, same for every entity
+    if new_category_uuid is None:
+        new_category_uuid = str(get_or_create_category("Project", new_project_name, tenant_uuid).uuid)
 
-    # 4. Then we need to update EC's project_name and project_reference attrs with  New Project
-    entity_cap.change_project_reference(new_project_uuid, new_project_name)
+    for entity_kind, entity_uuid in kind_uuid_pairs:
 
-    # 5. Save EC
-    if DRY_RUN:
-        log.info("[DRY RUN] Would update entity '%s' (%s) to project '%s' (%s)", entity_kind, entity_uuid, new_project_name, new_project_uuid)
-        return
-    entity_cap.save()
+        # 1. Find category uuid  corresponding to entity's EC for {"Project", "old project name"} category
+        entity_cap = EntityCapability(kind_name=entity_kind, kind_id=str(entity_uuid))
+        project_category_uuid = None
+        for c_uuid in entity_cap.category_id_list:
+            if category_key_index.key_name(c_uuid) == "Project":
+                project_category_uuid = str(c_uuid)
+                break
+
+        # 2. Then remove category uuid found in step 1 from EC's category_id_list attribute
+        entity_cap.remove_categories([project_category_uuid])
+
+        # 3. Add new Project category uuid to EC's category_id_list attribute
+        entity_cap.add_categories([new_category_uuid])
+
+        # 4. Then we need to update EC's project_name and project_reference attrs with  New Project
+        entity_cap.change_project_reference(new_project_uuid, new_project_name)
+
+        # 5. Save EC
+        if DRY_RUN:
+            log.info("[DRY RUN] Would update entity '%s' (%s) to project '%s' (%s)", entity_kind, entity_uuid, new_project_name, new_project_uuid)
+            continue
+        entity_cap.save()
 
 
 def update_vm_in_remote_pc(pc_ip, pc_username, pc_password, vm_uuid, new_project_name):
@@ -304,21 +884,135 @@ def update_vm_in_remote_pc(pc_ip, pc_username, pc_password, vm_uuid, new_project
     Raises:
         Exception when some operation fails
     """
-    headers = {'content-type': 'application/json'}
-    auth = (pc_username, pc_password)
-    category_url = "https://{}:9440/api/nutanix/v3/categories/CalmProject/{}".format(pc_ip, new_project_name)
-    response = requests.get(category_url, auth=auth, headers=headers, verify=False)
-    if response.status_code == 404:
-        log.info("Needed category (key: value) ({}, {}) does not exist on remote PC, need to create one".format("CalmProject", new_project_name))
-        category_create_paylod = {"description": "Created by CALM", "value": new_project_name}
-        response = requests.put(category_url, auth=auth, data=ujson.dumps(category_create_paylod), headers=headers, verify=False)
-        if response.status_code not in [200, 202]:
-            log.info("Response status code {}, respnse content {}".format(response.status_code, response.content))
-            raise Exception("Failed to create category, please contact Nutanix-calm team")
+    client = get_pc_client(pc_ip, pc_username, pc_password)
+    ensure_remote_project_category(client, new_project_name)
+    vm_api_path = "/vms/{}".format(vm_uuid)
+    for attempt in range(REMOTE_VM_CONFLICT_RETRIES + 1):
+        vm_get_response = get_remote_vm_with_project(client, vm_uuid, new_project_name)
+        if DRY_RUN:
+            log.info("[DRY RUN] Would update VM '%s' on remote PC '%s' to project '%s'", vm_uuid, pc_ip, new_project_name)
+            return
+        response = client.put(vm_api_path, vm_get_response)
+        if response.status_code != 409 or attempt == REMOTE_VM_CONFLICT_RETRIES:
+            break
+        # VM changed between GET and PUT, spec_version is stale so fetch it again
+        log.info("spec_version conflict while updating VM '{}', retrying ({}/{})".format(vm_uuid, attempt + 1, REMOTE_VM_CONFLICT_RETRIES))
+    if response.status_code not in [200, 202]:
+        log.info("Response status code {}, respnse content {}".format(response.status_code, response.content))
+        raise Exception("Failed to update VM on remote PC, please contact Nutanix-calm team")
+    log.info("Successfully updated remote pc  '{}' vm's categories to hold new project name".format(vm_uuid))
+
+
+def update_vms_in_remote_pc(pc_ip, pc_username, pc_password, vm_uuids, new_project_name, concurrency=REMOTE_VM_CONCURRENCY):
+    """
+    Update many VMs of a remote PC with new CalmProject category.
+    VM GET/PUT pairs run over a bounded pool sharing the pooled PC client, with PC_BATCH_SIZE
+    set the PUTs are sent through v3 batch API instead and conflicting ones are retried singly
+    Args:
+        pc_ip(str): PC ip
+        pc_username(str): PC username
+        pc_password(str): PC password
+        vm_uuids(list): VM uuids
+        new_project_name(str): value for Project category
+        concurrency(int): number of VMs updated in parallel
+    Raises:
+        Exception when some VM could not be updated
+    """
+    client = get_pc_client(pc_ip, pc_username, pc_password)
+    ensure_remote_project_category(client, new_project_name)
+    retry_vm_uuids = vm_uuids
+    failed_vm_uuids = []
+    if PC_BATCH_SIZE:
+        vm_specs = OrderedDict()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = OrderedDict(
+                (vm_uuid, executor.submit(get_remote_vm_with_project, client, vm_uuid, new_project_name))
+                for vm_uuid in vm_uuids
+            )
+            for vm_uuid, future in futures.items():
+                try:
+                    vm_specs[vm_uuid] = future.result()
+                except Exception as e:
+                    # The other VMs are still updated, this one is reported with the failures
+                    log.info("Failed to get VM '{}' from remote PC '{}': {}".format(vm_uuid, pc_ip, e))
+                    failed_vm_uuids.append(vm_uuid)
+        if DRY_RUN:
+            log.info("[DRY RUN] Would update VMs '%s' on remote PC '%s' to project '%s'", list(vm_specs), pc_ip, new_project_name)
+            # Nothing is sent, failed GETs are still reported below
+            vm_specs = OrderedDict()
+        api_requests = [("PUT", v3_path("vms", vm_uuid), vm_spec) for vm_uuid, vm_spec in vm_specs.items()]
+        retry_vm_uuids = []
+        for vm_uuid, (status_code, response) in zip(vm_specs, batch_requests(client, api_requests)):
+            if status_code in [200, 202]:
+                log.info("Successfully updated remote pc  '{}' vm's categories to hold new project name".format(vm_uuid))
+            elif status_code == 409:
+                retry_vm_uuids.append(vm_uuid)
+            else:
+                log.info("VM '{}' update status code {}, response {}".format(vm_uuid, status_code, response))
+                failed_vm_uuids.append(vm_uuid)
+    if retry_vm_uuids:
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(retry_vm_uuids)))) as executor:
+            futures = OrderedDict(
+                (vm_uuid, executor.submit(update_vm_in_remote_pc, pc_ip, pc_username, pc_password, vm_uuid, new_project_name))
+                for vm_uuid in retry_vm_uuids
+            )
+            for vm_uuid, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    log.info("Failed to update VM '{}' on remote PC '{}': {}".format(vm_uuid, pc_ip, e))
+                    failed_vm_uuids.append(vm_uuid)
+    if failed_vm_uuids:
+        raise Exception("Failed to update VMs {} on remote PC, please contact Nutanix-calm team".format(failed_vm_uuids))
 
-    vm_api_url = "https://{}:9440/api/nutanix/v3/vms/{}".format(pc_ip, vm_uuid)
-    log.info("VM GET URL: '{}'".format(vm_api_url))
-    response = requests.get(vm_api_url, auth=auth, headers=headers, verify=False)
+
+# (pc_ip, project name) pairs whose CalmProject category is known to exist on that remote PC
+_remote_project_categories = set()
+_remote_project_categories_lock = threading.Lock()
+
+
+def ensure_remote_project_category(client, new_project_name):
+    """
+    Create CalmProject category value for new_project_name on remote PC if it does not exist
+    Args:
+        client(PCClient): client of the remote PC
+        new_project_name(str): value for CalmProject category
+    """
+    cache_key = (client.pc_ip, new_project_name)
+    if cache_key in _remote_project_categories:
+        return
+    # Held across the check so parallel updates of one project wait instead of racing to create it
+    with _remote_project_categories_lock:
+        if cache_key in _remote_project_categories:
+            return
+        category_path = "/categories/CalmProject/{}".format(new_project_name)
+        response = client.get(category_path)
+        if response.status_code == 404:
+            log.info("Needed category (key: value) ({}, {}) does not exist on remote PC, need to create one".format("CalmProject", new_project_name))
+            category_create_paylod = {"description": "Created by CALM", "value": new_project_name}
+            response = client.put(category_path, category_create_paylod)
+            if response.status_code not in [200, 202]:
+                log.info("Response status code {}, respnse content {}".format(response.status_code, response.content))
+                raise Exception("Failed to create category, please contact Nutanix-calm team")
+        elif response.status_code not in [200, 202]:
+            # Lookup failed for some other reason, leave it uncached so the next call checks again
+            return
+        _remote_project_categories.add(cache_key)
+
+
+def get_remote_vm_with_project(client, vm_uuid, new_project_name):
+    """
+    Get VM spec from remote PC with CalmProject category set to new_project_name
+    Args:
+        client(PCClient): client of the remote PC
+        vm_uuid(str): VM uuid
+        new_project_name(str): value for CalmProject category
+    Returns:
+        dict: VM spec and metadata ready to be PUT
+    """
+    vm_api_path = "/vms/{}".format(vm_uuid)
+    log.info("VM GET URL: '{}'".format(client.base_url + vm_api_path))
+    response = client.get(vm_api_path)
     if response.status_code not in [200, 202]:
         log.info("Response status code {}, respnse content {}".format(response.status_code, response.content))
         raise Exception("Failed to get VM from a remote PC, please contact Nutanix-calm team")
@@ -327,18 +1021,19 @@ def update_vm_in_remote_pc(pc_ip, pc_username, pc_password, vm_uuid, new_project
     vm_get_response.pop('status')
     categories = vm_get_response.get('metadata', {}).get('categories', {})
     categories['CalmProject'] = new_project_name
-    if DRY_RUN:
-        log.info("[DRY RUN] Would update VM '%s' on remote PC '%s' to project '%s'", vm_uuid, pc_ip, new_project_name)
-        return
-    response = requests.put(vm_api_url, auth=auth, data=ujson.dumps(vm_get_response), headers=headers, verify=False)
-    if response.status_code not in [200, 202]:
-        log.info("Response status code {}, respnse content {}".format(response.status_code, response.content))
-        raise Exception("Failed to update VM on remote PC, please contact Nutanix-calm team")
+    return vm_get_response
+
+
+# (name, value, tenant_uuid) -> category object. Only categories known to exist are cached,
+# so creating a category just adds its entry and a cached miss can never go stale
+_category_cache = {}
+_category_cache_lock = threading.Lock()
+category_lookups_saved = 0
 
 
 def get_or_create_category(name, value, tenant_uuid):
     """
-    Get or create catgory for given arguments
+    Get or create catgory for given arguments, memoized per process
     Args:
         name(str): Category key
         value(str): Category value
@@ -346,10 +1041,22 @@ def get_or_create_category(name, value, tenant_uuid):
     Returns:
         object: category object
     """
+    # Held across lookup and create, so concurrent callers cannot each create the same category
+    with _category_cache_lock:
+        return _get_or_create_category(name, value, tenant_uuid)
+
+
+def _get_or_create_category(name, value, tenant_uuid):
+    global category_lookups_saved
+    cache_key = (name, value, tenant_uuid)
+    if cache_key in _category_cache:
+        category_lookups_saved += 1
+        return _category_cache[cache_key]
     category_obj = Category()
     category_obj.lookup_category_by_name_value(name, value)
     if hasattr(category_obj, "value") and category_obj.value == value:
         log.info("category with name '{}' and value '{}', already exists , hence no need to create".format(name, value))
+        _category_cache[cache_key] = category_obj
         return category_obj
     category_obj.tenant_uuid = tenant_uuid
     category_obj.initialize(name, value, "Created by CALM", None, True)
@@ -357,4 +1064,5 @@ def get_or_create_category(name, value, tenant_uuid):
         log.info("[DRY RUN] Would create category with name '%s' and value '%s'", name, value)
         return category_obj  # or None, depending on your logic
     category_obj.save()
+    _category_cache[cache_key] = category_obj
     return category_obj
\ No newline at end of file
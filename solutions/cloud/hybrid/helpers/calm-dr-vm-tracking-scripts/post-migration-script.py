@@ -2,19 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import os
-import requests
+import argparse
 import json
 import ujson
 import copy
 import time
-from itertools import islice
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from calm.common.flags import gflags
 from calm.lib.model.store.db_session import flush_session
 from aplos.insights.entity_capability import EntityCapability
 import calm.lib.model as model
-from helper import change_project, init_contexts, log, DRY_RUN
+try:
+    from calm.lib.proto import NutanixSubstrateElement as NutanixSubstrateElementProto
+except ImportError:
+    # No IDF projection of substrate elements on this Calm version, elements are queried per VM instead
+    NutanixSubstrateElementProto = None
+import helper
+from helper import change_projects, account_index, init_contexts, get_pc_client, fetch_projection, LRUCache, WriteBehind, log, DRY_RUN
 
 # Validate environment variables
 required_env = ['DEST_PC_IP', 'DEST_PROJECT_NAME', 'SOURCE_PROJECT_NAME', 'DEST_PC_USER', 'DEST_PC_PASS']
@@ -23,15 +35,29 @@ if missing_env:
     raise Exception(f"Please export required environment variables: {', '.join(missing_env)}")
 
 DEST_PC_IP = os.environ['DEST_PC_IP']
-PC_PORT = 9440
 LENGTH = 100
+VM_LIST_LENGTH = 500
+SUBNET_LIST_LENGTH = 500
+VM_FETCH_CONCURRENCY = int(os.environ.get("VM_FETCH_CONCURRENCY", "10"))
+RECOVERY_JOB_CONCURRENCY = int(os.environ.get("RECOVERY_JOB_CONCURRENCY", "10"))
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "100"))
+AUTO_TUNE_BATCH = os.environ.get("AUTO_TUNE_BATCH", "false").lower() == "true"
+TARGET_FLUSH_SECONDS = float(os.environ.get("TARGET_FLUSH_SECONDS", "5"))
+APP_CACHE_SIZE = int(os.environ.get("APP_CACHE_SIZE", "1000"))
+# Set to empty string to disable the recovery plan job checkpoint
+VM_MAP_STATE_FILE = os.environ.get("VM_MAP_STATE_FILE", f"vm_map_state_{DEST_PC_IP}.jsonl")
+PIPELINE = os.environ.get("PIPELINE", "false").lower() == "true"
+# Per VM progress journal for --resume, set to empty string to disable
+JOURNAL_FILE = os.environ.get("JOURNAL_FILE", f"post_migration_journal_{DEST_PC_IP}.sqlite")
+# Processes running update_substrates on application shards, 1 runs it in this process
+WORKERS = int(os.environ.get("WORKERS", "1"))
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "1000"))
+PIPELINE_LOG_INTERVAL = float(os.environ.get("PIPELINE_LOG_INTERVAL", "10"))
 
-dest_base_url = f"https://{DEST_PC_IP}:{PC_PORT}/api/nutanix/v3"
-dest_pc_auth = { "username": os.environ['DEST_PC_USER'], "password": os.environ['DEST_PC_PASS']}
+dest_client = get_pc_client(DEST_PC_IP, os.environ['DEST_PC_USER'], os.environ['DEST_PC_PASS'])
 
 DEST_PROJECT = os.environ['DEST_PROJECT_NAME']
 SRC_PROJECT = os.environ['SOURCE_PROJECT_NAME']
-headers = {'content-type': 'application/json', 'Accept': 'application/json'}
 
 def print_header():
     print("="*60)
@@ -39,70 +65,334 @@ def print_header():
     print(f"      Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S')}")
     print("="*60)
 
-def get_vm(base_url, auth, uuid):
-    method = 'GET'
-    url = base_url + f"/vms/{uuid}"
-    resp = requests.request(
-            method,
-            url,
-            headers=headers,
-            auth=(auth["username"], auth["password"]),
-            verify=False
-    )
+def get_vm(client, uuid):
+    resp = client.get(f"/vms/{uuid}")
     if resp.ok:
         return resp.json()
     else:
         log.error("Failed to get vm '%s'. Status: %s, Response: %s", uuid, resp.status_code, resp.text)
         raise Exception(f"Failed to get vm '{uuid}'.")
 
+def list_vms(client, offset, length=VM_LIST_LENGTH):
+    payload = {"kind": "vm", "length": length, "offset": offset}
+    resp = client.post("/vms/list", payload)
+    if resp.ok:
+        resp_json = resp.json()
+        return resp_json["entities"], resp_json["metadata"]["total_matches"]
+    else:
+        log.error("Failed to list vms at offset %s. Status: %s, Response: %s", offset, resp.status_code, resp.text)
+        raise Exception("Failed to list vms.")
+
+def load_vm_index(client, executor, vm_uuids):
+    """
+    Page through the VMs of the PC once via vms/list and index the ones in vm_uuids by uuid.
+    The v3 list filter cannot match on uuid, so filtering happens here and only wanted VMs are kept.
+    If paging the whole inventory would take more calls than fetching the wanted VMs one by one,
+    only the first page is used and the remaining VMs are left to get_vm.
+    """
+    wanted = set(vm_uuids)
+    vm_index = {}
+
+    def index_page(entities):
+        for vm in entities:
+            uuid = vm["metadata"]["uuid"]
+            if uuid in wanted:
+                vm_index[uuid] = vm
+
+    entities, total_matches = list_vms(client, 0)
+    index_page(entities)
+    offsets = range(VM_LIST_LENGTH, total_matches, VM_LIST_LENGTH)
+    if len(offsets) > len(wanted) - len(vm_index):
+        log.info("Skipping bulk VM load, %d list pages needed for %d remaining VMs.", len(offsets), len(wanted) - len(vm_index))
+        return vm_index
+    for entities, _ in executor.map(lambda offset: list_vms(client, offset), offsets):
+        index_page(entities)
+    log.info("Loaded %d of %d VMs from %d vms/list pages.", len(vm_index), len(wanted), len(offsets) + 1)
+    return vm_index
+
 def get_account_uuid_map():
-    nutanix_pc_accounts = model.NutanixPCAccount.query(deleted=False)
-    dest_account_uuid_map = {}
-    pc_account = None
-    for account in nutanix_pc_accounts:
-        if account.data.server == DEST_PC_IP:
-            pc_account = account
-            break
-
-    if not pc_account:
+    dest_account_uuid_map = account_index.get_cluster_account_map(DEST_PC_IP)
+    if dest_account_uuid_map is None:
         raise Exception(f"Unable to find destination PC account '{DEST_PC_IP}'")
-
-    for pe in pc_account.data.nutanix_account:
-        dest_account_uuid_map[pe.data.cluster_uuid] = str(pe.uuid)
     return dest_account_uuid_map
 
-def get_vpc_reference(base_url, auth, subnet_uuid):
+def get_subnet(client, subnet_uuid):
+    """Get subnet json for a given subnet, returns None if it can not be fetched."""
+    try:
+        resp = client.get(f"/subnets/{subnet_uuid}")
+        if resp.ok:
+            return resp.json()
+        log.warning("Failed to get subnet '%s' details. Status: %s, Response: %s",
+                   subnet_uuid, resp.status_code, resp.text)
+    except Exception as e:
+        log.warning("Error getting subnet '%s': %s", subnet_uuid, e)
+    return None
+
+def get_subnet_vpc_uuid(subnet):
     """
-    Get VPC reference UUID for a given subnet.
+    Get VPC reference UUID of a subnet json.
     Returns None if the subnet is not in a VPC (e.g., regular VLAN-backed subnets).
     """
-    url = base_url + f"/subnets/{subnet_uuid}"
-    try:
-        resp = requests.request(
-            'GET',
-            url,
-            headers=headers,
-            auth=(auth["username"], auth["password"]),
-            verify=False
-        )
-        if resp.ok:
+    # Safely check if vpc_reference exists (only present for VPC subnets)
+    vpc_ref = subnet.get("status", {}).get("resources", {}).get("vpc_reference")
+    if vpc_ref:
+        return vpc_ref.get("uuid")
+    log.debug("Subnet '%s' is not in a VPC (no vpc_reference found)", subnet.get("metadata", {}).get("uuid"))
+    return None
+
+class SubnetVpcCache(object):
+    """
+    Subnet uuid -> VPC uuid cache for the destination PC.
+    Populated once from subnets/list, single subnets are fetched on a miss.
+    Subnets without vpc_reference (VLAN subnets) are cached as None.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.vpc_by_subnet = {}
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self):
+        total_matches = 1
+        offset = 0
+        while offset < total_matches:
+            payload = {"kind": "subnet", "length": SUBNET_LIST_LENGTH, "offset": offset}
+            resp = self.client.post("/subnets/list", payload)
+            if not resp.ok:
+                log.warning("Failed to list subnets, falling back to per subnet lookups. Status: %s, Response: %s",
+                            resp.status_code, resp.text)
+                return
             resp_json = resp.json()
-            # Safely check if vpc_reference exists (only present for VPC subnets)
-            vpc_ref = resp_json.get("status", {}).get("resources", {}).get("vpc_reference")
-            if vpc_ref:
-                return vpc_ref.get("uuid")
-            else:
-                log.debug(f"Subnet '{subnet_uuid}' is not in a VPC (no vpc_reference found)")
-                return None
-        else:
-            log.warning("Failed to get subnet '%s' details. Status: %s, Response: %s", 
-                       subnet_uuid, resp.status_code, resp.text)
+            for subnet in resp_json["entities"]:
+                self.vpc_by_subnet[subnet["metadata"]["uuid"]] = get_subnet_vpc_uuid(subnet)
+            total_matches = resp_json["metadata"]["total_matches"]
+            offset += SUBNET_LIST_LENGTH
+        log.info("Cached VPC references of %d subnets.", len(self.vpc_by_subnet))
+
+    def get_vpc_uuid(self, subnet_uuid):
+        if subnet_uuid in self.vpc_by_subnet:
+            self.hits += 1
+            return self.vpc_by_subnet[subnet_uuid]
+        self.misses += 1
+        subnet = get_subnet(self.client, subnet_uuid)
+        if subnet is None:
+            # Not cached so that a transient failure is retried for the next VM
             return None
+        vpc_uuid = get_subnet_vpc_uuid(subnet)
+        self.vpc_by_subnet[subnet_uuid] = vpc_uuid
+        return vpc_uuid
+
+subnet_cache = SubnetVpcCache(dest_client)
+
+app_cache = LRUCache(APP_CACHE_SIZE)
+# Modified model objects, saved once per batch right before flush_session()
+write_behind = WriteBehind()
+
+class RunJournal(object):
+    """
+    SQLite journal of per VM relink progress, read by --resume.
+    A VM is journaled 'fetched' with its destination uuid when its relink starts, and the VMs completed
+    by a flush are marked 'flushed' in one short transaction right after flush_session(). Model saves
+    are write-behind, nothing of a VM is in the Calm store before its flush, so there are no steps in
+    between and a VM left at 'fetched' is redone on resume. Redoing is safe, the substrate element
+    index also covers destination uuids.
+    """
+    STEPS = ("fetched", "flushed")
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        # Autocommit with WAL: --workers processes share the file and no write transaction is held
+        # across a batch, so a writer only waits for another process's single statement
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS vm_state "
+                          "(vm_uuid TEXT PRIMARY KEY, mapped_uuid TEXT, step TEXT, updated_at REAL)")
+        if not resume:
+            self.conn.execute("DELETE FROM vm_state")
+
+    def record(self, vm_uuid, step, mapped_uuid=None):
+        if mapped_uuid is not None:
+            self.conn.execute("INSERT OR REPLACE INTO vm_state VALUES (?, ?, ?, ?)", (vm_uuid, mapped_uuid, step, time.time()))
+        else:
+            self.conn.execute("UPDATE vm_state SET step = ?, updated_at = ? WHERE vm_uuid = ?", (step, time.time(), vm_uuid))
+
+    def mark_flushed(self, vm_uuids):
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany("UPDATE vm_state SET step = 'flushed', updated_at = ? WHERE vm_uuid = ?",
+                                  [(now, vm_uuid) for vm_uuid in vm_uuids])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def flushed_mapped_uuid(self, vm_uuid):
+        """Destination uuid the VM was flushed with, None if it is not journaled as flushed"""
+        row = self.conn.execute("SELECT mapped_uuid FROM vm_state WHERE vm_uuid = ? AND step = 'flushed'", (vm_uuid,)).fetchone()
+        return row[0] if row else None
+
+    def pending(self, vm_uuid_map):
+        """
+        vm_uuid_map without the VMs already flushed, a VM now mapped to another destination VM
+        (by a newer recovery plan job) is done again
+        """
+        flushed = dict(self.conn.execute("SELECT vm_uuid, mapped_uuid FROM vm_state WHERE step = 'flushed'"))
+        pending = OrderedDict(
+            (vm_uuid, mapped_uuid) for vm_uuid, mapped_uuid in vm_uuid_map.items()
+            if flushed.get(vm_uuid) != mapped_uuid
+        )
+        steps = dict(self.conn.execute("SELECT step, COUNT(*) FROM vm_state GROUP BY step"))
+        log.info("Resume: skipping %d flushed VMs, %d VMs left (journal steps %s).",
+                 len(vm_uuid_map) - len(pending), len(pending), steps)
+        return pending
+
+    def close(self):
+        self.conn.close()
+
+journal = None
+
+def open_journal(path, resume=False):
+    """Open the run journal of this process, there is none in dry run or with an empty path"""
+    global journal
+    if path and not DRY_RUN:
+        journal = RunJournal(path, resume)
+    return journal
+
+# A journal error only costs resumability, it never stops the relink
+
+def journal_step(vm_uuid, step, mapped_uuid=None):
+    if journal:
+        try:
+            journal.record(vm_uuid, step, mapped_uuid)
+        except Exception as e:
+            log.warning("Failed to journal step '%s' of VM %s: %s", step, vm_uuid, e)
+
+def journal_flushed(vm_uuids):
+    if journal and vm_uuids:
+        try:
+            journal.mark_flushed(vm_uuids)
+        except Exception as e:
+            log.warning("Failed to journal %d flushed VMs, --resume will redo them: %s", len(vm_uuids), e)
+
+def journal_flushed_mapped_uuid(vm_uuid):
+    if not journal:
+        return None
+    try:
+        return journal.flushed_mapped_uuid(vm_uuid)
     except Exception as e:
-        log.warning("Error getting VPC reference for subnet '%s': %s", subnet_uuid, e)
+        log.warning("Failed to read journal state of VM %s: %s", vm_uuid, e)
         return None
 
-def update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map):
+def get_application(app_profile_instance_reference):
+    """Application of an AppProfileInstance, cached for the run as most apps have several VMs"""
+    key = str(app_profile_instance_reference)
+    application = app_cache.get(key)
+    if application is None:
+        application = model.AppProfileInstance.get_object(app_profile_instance_reference).application
+        app_cache.put(key, application)
+    return application
+
+def load_substrate_element_uuids(instance_ids=None):
+    """
+    Map instance_id -> uuid of the non-deleted NutanixSubstrateElements from a paged IDF projection,
+    which reads the instance_id attribute only. With instance_ids only those elements are kept.
+    """
+    nse_uuids = {}
+    for row in fetch_projection(NutanixSubstrateElementProto, ["instance_id"], deleted=False):
+        instance_id = str(row[1][0])
+        if instance_ids is None or instance_id in instance_ids:
+            nse_uuids[instance_id] = str(row[0])
+    return nse_uuids
+
+def load_substrate_elements(nse_uuids):
+    """
+    Load substrate elements by uuid from an {instance_id: NSE uuid} map, returns {instance_id: NSE}.
+    A --workers shard gets this map from the parent, so it does not look its elements up again.
+    """
+    nse_by_uuid = {}
+    nse_index = {}
+    for instance_id, nse_uuid in nse_uuids.items():
+        if nse_uuid not in nse_by_uuid:
+            nse_by_uuid[nse_uuid] = model.NutanixSubstrateElement.get_object(nse_uuid)
+        if nse_by_uuid[nse_uuid]:
+            nse_index[instance_id] = nse_by_uuid[nse_uuid]
+    return nse_index
+
+def query_substrate_element(instance_id):
+    """Non-deleted NutanixSubstrateElement of a VM through the model, None if there is none"""
+    return model.NutanixSubstrateElement.query(instance_id=instance_id, deleted=False) or None
+
+def load_substrate_element_index(vm_uuid_map):
+    """
+    Load the non-deleted NutanixSubstrateElements of the VMs in vm_uuid_map, returns {instance_id: NSE}.
+    A paged IDF projection of instance_id finds the elements, only those are loaded as model objects.
+    Both source and destination uuids are indexed, so elements already relinked by an earlier
+    (interrupted) run are found as well. Without the projection each VM is queried on its own.
+    """
+    instance_ids = set(vm_uuid_map.keys())
+    instance_ids.update(uuid for uuid in vm_uuid_map.values() if uuid)
+    nse_uuids = None
+    if NutanixSubstrateElementProto is not None:
+        try:
+            nse_uuids = load_substrate_element_uuids(instance_ids)
+        except Exception as e:
+            log.warning("Substrate element projection failed, querying elements per VM: %s", e)
+    if nse_uuids is not None:
+        nse_index = load_substrate_elements(nse_uuids)
+    else:
+        nse_index = {}
+        for instance_id in instance_ids:
+            NSE = query_substrate_element(instance_id)
+            if NSE:
+                nse_index[instance_id] = NSE
+    log.info("Indexed %d substrate elements for %d VMs.", len(nse_index), len(vm_uuid_map))
+    return nse_index
+
+class SubstrateElementIndex(object):
+    """
+    {instance_id: NSE} index for the pipeline, which does not know its VMs up front.
+    One paged IDF projection maps the instance_id of every non-deleted element to its uuid, an element
+    is loaded as model object only when a VM asks for it. Without the projection each VM is queried.
+    """
+
+    def __init__(self):
+        self.nse_uuids = None
+        if NutanixSubstrateElementProto is not None:
+            try:
+                self.nse_uuids = load_substrate_element_uuids()
+            except Exception as e:
+                log.warning("Substrate element projection failed, querying elements per VM: %s", e)
+        # instance_id -> NSE (None if there is none), NSE uuid -> NSE
+        self.elements = {}
+        self.nse_by_uuid = {}
+        if self.nse_uuids is not None:
+            log.info("Indexed %d substrate element uuids.", len(self.nse_uuids))
+
+    def get(self, instance_id, default=None):
+        instance_id = str(instance_id)
+        if instance_id not in self.elements:
+            if self.nse_uuids is None:
+                NSE = query_substrate_element(instance_id)
+            else:
+                nse_uuid = self.nse_uuids.get(instance_id)
+                if nse_uuid and nse_uuid not in self.nse_by_uuid:
+                    self.nse_by_uuid[nse_uuid] = model.NutanixSubstrateElement.get_object(nse_uuid)
+                # Source and destination uuid of a VM share one object, so a relink is seen through both
+                NSE = self.nse_by_uuid.get(nse_uuid) if nse_uuid else None
+            self.elements[instance_id] = NSE
+        return self.elements[instance_id] or default
+
+    def __setitem__(self, instance_id, NSE):
+        self.elements[str(instance_id)] = NSE
+
+def update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map, nse_index):
+    """
+    Relink the VM level objects (NSE, replica group NS and its create action, NSC) of a VM.
+    Returns the VM's application for the app level pass (update_app_info), None if there is none.
+    """
     instance_id = vm_uuid
     vm_name = vm["status"]["name"]
     cluster_uuid = vm["status"]["cluster_reference"]["uuid"]
@@ -111,17 +401,16 @@ def update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map):
     nics_list = vm["status"]["resources"]["nic_list"]
     for _nic in nics_list:
         subnet_uuid = _nic["subnet_reference"]["uuid"]
-        vpc_uuid = get_vpc_reference(dest_base_url, dest_pc_auth, subnet_uuid)
+        vpc_uuid = subnet_cache.get_vpc_uuid(subnet_uuid)
         if vpc_uuid:
             _nic["vpc_reference"] = {"kind": "vpc", "uuid": vpc_uuid}
     vm["status"]["resources"]["nic_list"] = nics_list
     
-    NSE = model.NutanixSubstrateElement.query(instance_id=instance_id, deleted=False)
+    NSE = nse_index.get(instance_id) or nse_index.get(vm_uuid_map[instance_id])
     app_name = None
     if NSE:
-        NSE = NSE[0]
         try:
-            application = model.AppProfileInstance.get_object(NSE.app_profile_instance_reference).application
+            application = get_application(NSE.app_profile_instance_reference)
             app_name = application.name
         except Exception as e:
             log.warning("Could not find application for AppProfileInstance reference '%s': %s", NSE.app_profile_instance_reference, e)
@@ -137,6 +426,7 @@ def update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map):
             else:
                 NSE.instance_id = vm_uuid_map[instance_id]
                 instance_id = vm_uuid_map[instance_id]
+                nse_index[instance_id] = NSE
 
         if DRY_RUN:
             log.info(prefix + "[DRY RUN] Would update substrate/account/cluster/platform data for VM '%s'", vm_name)
@@ -169,8 +459,8 @@ def update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map):
                     else:
                         NSE.spec.resources.disk_list[i].data_source_reference = None
             if not DRY_RUN:
-                NSE.save()
-                log.info(prefix + "Saved updated NutanixSubstrateElement for VM '%s'.", vm_name)
+                write_behind.mark(NSE, [vm_uuid])
+                log.info(prefix + "Updated NutanixSubstrateElement for VM '%s'.", vm_name)
 
         log.info(prefix + "Updating VM substrate for '%s' with instance_id '%s'.", vm_name, instance_id)
         NS = NSE.replica_group
@@ -204,9 +494,9 @@ def update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map):
                                 # Update VPC reference if it exists (for VPC-based subnets)
                                 if vm["status"]["resources"]["nic_list"][i].get("vpc_reference"):
                                     nic.vpc_reference = vm["status"]["resources"]["nic_list"][i]["vpc_reference"]
-                        task.save()
-            NS.save()
-            log.info(prefix + "Saved updated replica_group for VM '%s'.", vm_name)
+                            write_behind.mark(task, [vm_uuid])
+            write_behind.mark(NS, [vm_uuid])
+            log.info(prefix + "Updated replica_group for VM '%s'.", vm_name)
 
         log.info(prefix + "Updating VM substrate cfg for '%s' with instance_id '%s'.", vm_name, instance_id)
         NSC = NS.config
@@ -254,194 +544,324 @@ def update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map):
                             ref_disk.data_source_reference = None
                     NSC.spec.resources.disk_list.append(ref_disk)
             if not DRY_RUN:
-                NSC.save()
-                log.info(prefix + "Saved updated substrate config for VM '%s'.", vm_name)
+                write_behind.mark(NSC, [vm_uuid])
+                log.info(prefix + "Updated substrate config for VM '%s'.", vm_name)
 
-        log.info(prefix + "Updating VM clone blueprint for '%s' with instance_id '%s'.", vm_name, instance_id)
         try:
-            application = model.AppProfileInstance.get_object(NSE.app_profile_instance_reference).application
+            return get_application(NSE.app_profile_instance_reference)
         except Exception as e:
             log.warning("Could not find application for AppProfileInstance reference '%s': %s", NSE.app_profile_instance_reference, e)
-            return
-        if DRY_RUN:
-            log.info(prefix + "[DRY RUN] Would update clone blueprint and patch config for VM '%s'", vm_name)
-            return
-        clone_bp = application.app_blueprint_config
-        clone_bp_intent_spec_dict = json.loads(clone_bp.intent_spec)
-        for substrate_cfg in clone_bp_intent_spec_dict.get("resources").get("substrate_definition_list"):
-            nic_list = substrate_cfg.get("create_spec").get("resources").get("nic_list")
-            for i, nic in enumerate(nic_list):
-                nic["subnet_reference"] = vm["status"]["resources"]["nic_list"][i]["subnet_reference"]
+    return None
+
+def update_app_info(application, vm, dest_account_uuid_map, owners=()):
+    """
+    Relink the app level objects (clone blueprint, patches and app profile instance intent_spec) of an application.
+    These objects are shared by all VMs of the app, so this runs once per app with its last processed VM,
+    which is the state the former per VM rewrite ended with. owners are the uuids of the VMs the objects
+    are saved for.
+    """
+    prefix = f"[App: {application.name}] "
+    vm_name = vm["status"]["name"]
+    instance_id = vm["metadata"]["uuid"]
+    cluster_uuid = vm["status"]["cluster_reference"]["uuid"]
+    if DRY_RUN:
+        log.info(prefix + "[DRY RUN] Would update clone blueprint and patch config for VM '%s'", vm_name)
+        return
+    log.info(prefix + "Updating VM clone blueprint for '%s' with instance_id '%s'.", vm_name, instance_id)
+    clone_bp = application.app_blueprint_config
+    clone_bp_intent_spec_dict = json.loads(clone_bp.intent_spec)
+    for substrate_cfg in clone_bp_intent_spec_dict.get("resources").get("substrate_definition_list"):
+        nic_list = substrate_cfg.get("create_spec").get("resources").get("nic_list")
+        for i, nic in enumerate(nic_list):
+            nic["subnet_reference"] = vm["status"]["resources"]["nic_list"][i]["subnet_reference"]
+            # Update VPC reference if it exists (for VPC-based subnets)
+            if vm["status"]["resources"]["nic_list"][i].get("vpc_reference"):
+                nic["vpc_reference"] = vm["status"]["resources"]["nic_list"][i]["vpc_reference"]
+        substrate_cfg["create_spec"]["resources"]["account_uuid"] = dest_account_uuid_map[cluster_uuid]
+
+    clone_bp.intent_spec = json.dumps(clone_bp_intent_spec_dict)
+    write_behind.mark(clone_bp, owners)
+
+    log.info(prefix + "Updating patch config action for '%s' with instance_id '%s'.", vm_name, instance_id)
+    vm_first_nic_subnet_uuid = ""
+    vm_first_nic_vpc_uuid = ""
+    if len(vm["status"]["resources"]["nic_list"]) > 0:
+        vm_first_nic_subnet_uuid = vm["status"]["resources"]["nic_list"][0]["subnet_reference"]["uuid"]
+        # Get VPC reference from first NIC if it exists (for VPC-based subnets)
+        if vm["status"]["resources"]["nic_list"][0].get("vpc_reference"):
+            vm_first_nic_vpc_uuid = vm["status"]["resources"]["nic_list"][0]["vpc_reference"].get("uuid", "")
+    for patch in application.active_app_profile_instance.patches:
+        patch_attr_list = patch.attrs_list[0]
+        patch_data = patch_attr_list.data
+        for i in range(len(patch_data.pre_defined_nic_list)):
+            if patch_data.pre_defined_nic_list[i].operation == "add":
+                patch_data.pre_defined_nic_list[i].subnet_reference.uuid=vm_first_nic_subnet_uuid
                 # Update VPC reference if it exists (for VPC-based subnets)
-                if vm["status"]["resources"]["nic_list"][i].get("vpc_reference"):
-                    nic["vpc_reference"] = vm["status"]["resources"]["nic_list"][i]["vpc_reference"]
-            substrate_cfg["create_spec"]["resources"]["account_uuid"] = dest_account_uuid_map[cluster_uuid]
-
-        clone_bp.intent_spec = json.dumps(clone_bp_intent_spec_dict)
-        clone_bp.save()
-
-        log.info(prefix + "Updating patch config action for '%s' with instance_id '%s'.", vm_name, instance_id)
-        vm_first_nic_subnet_uuid = ""
-        vm_first_nic_vpc_uuid = ""
-        if len(vm["status"]["resources"]["nic_list"]) > 0:
-            vm_first_nic_subnet_uuid = vm["status"]["resources"]["nic_list"][0]["subnet_reference"]["uuid"]
-            # Get VPC reference from first NIC if it exists (for VPC-based subnets)
-            if vm["status"]["resources"]["nic_list"][0].get("vpc_reference"):
-                vm_first_nic_vpc_uuid = vm["status"]["resources"]["nic_list"][0]["vpc_reference"].get("uuid", "")
-        for patch in application.active_app_profile_instance.patches:
-            patch_attr_list = patch.attrs_list[0]
-            patch_data = patch_attr_list.data
-            for i in range(len(patch_data.pre_defined_nic_list)):
-                if patch_data.pre_defined_nic_list[i].operation == "add":
-                    patch_data.pre_defined_nic_list[i].subnet_reference.uuid=vm_first_nic_subnet_uuid
+                if vm_first_nic_vpc_uuid:
+                    patch_data.pre_defined_nic_list[i].vpc_reference = {"kind": "vpc", "uuid": vm_first_nic_vpc_uuid}
+            else:
+                if len(vm["status"]["resources"]["nic_list"]) >= i + 1:
+                    patch_data.pre_defined_nic_list[i].subnet_reference.uuid=vm["status"]["resources"]["nic_list"][i]["subnet_reference"]["uuid"]
                     # Update VPC reference if it exists (for VPC-based subnets)
-                    if vm_first_nic_vpc_uuid:
-                        patch_data.pre_defined_nic_list[i].vpc_reference = {"kind": "vpc", "uuid": vm_first_nic_vpc_uuid}
+                    if vm["status"]["resources"]["nic_list"][i].get("vpc_reference"):
+                        patch_data.pre_defined_nic_list[i].vpc_reference.uuid = vm["status"]["resources"]["nic_list"][i]["vpc_reference"].get("uuid", "")
                 else:
-                    if len(vm["status"]["resources"]["nic_list"]) >= i + 1:
-                        patch_data.pre_defined_nic_list[i].subnet_reference.uuid=vm["status"]["resources"]["nic_list"][i]["subnet_reference"]["uuid"]
-                        # Update VPC reference if it exists (for VPC-based subnets)
-                        if vm["status"]["resources"]["nic_list"][i].get("vpc_reference"):
-                            patch_data.pre_defined_nic_list[i].vpc_reference.uuid = vm["status"]["resources"]["nic_list"][i]["vpc_reference"].get("uuid", "")
-                    else:
-                        patch_data.pre_defined_nic_list[i].subnet_reference.uuid = vm_first_nic_subnet_uuid
-                        # Update VPC reference if it exists (for VPC-based subnets)
-                        if vm_first_nic_vpc_uuid:
-                            patch_data.pre_defined_nic_list[i].vpc_reference.uuid = vm_first_nic_vpc_uuid
-            patch.save()
-            application.active_app_profile_instance.save()
-            application.save()
-        app_intent_spec = application.active_app_profile_instance.intent_spec
-        app_intent_spec_dict = ujson.loads(app_intent_spec)
-        log.info(prefix + "Updating patch active app profile instance for '%s' with instance_id '%s'.", vm_name, instance_id)
-        for patch in app_intent_spec_dict["resources"]["patch_list"]:
-            patch_data = patch["attrs_list"][0]["data"]
-            for i in range(len(patch_data["pre_defined_nic_list"])):
-                if patch_data["pre_defined_nic_list"][i]["operation"] == "add":
-                    patch_data["pre_defined_nic_list"][i]["subnet_reference"]["uuid"]=vm_first_nic_subnet_uuid
+                    patch_data.pre_defined_nic_list[i].subnet_reference.uuid = vm_first_nic_subnet_uuid
                     # Update VPC reference if it exists (for VPC-based subnets)
                     if vm_first_nic_vpc_uuid:
-                        patch_data["pre_defined_nic_list"][i]["vpc_reference"] = {"kind": "vpc", "uuid": vm_first_nic_vpc_uuid}
+                        patch_data.pre_defined_nic_list[i].vpc_reference.uuid = vm_first_nic_vpc_uuid
+        write_behind.mark(patch, owners)
+        write_behind.mark(application.active_app_profile_instance, owners)
+        write_behind.mark(application, owners)
+    app_intent_spec = application.active_app_profile_instance.intent_spec
+    app_intent_spec_dict = ujson.loads(app_intent_spec)
+    log.info(prefix + "Updating patch active app profile instance for '%s' with instance_id '%s'.", vm_name, instance_id)
+    for patch in app_intent_spec_dict["resources"]["patch_list"]:
+        patch_data = patch["attrs_list"][0]["data"]
+        for i in range(len(patch_data["pre_defined_nic_list"])):
+            if patch_data["pre_defined_nic_list"][i]["operation"] == "add":
+                patch_data["pre_defined_nic_list"][i]["subnet_reference"]["uuid"]=vm_first_nic_subnet_uuid
+                # Update VPC reference if it exists (for VPC-based subnets)
+                if vm_first_nic_vpc_uuid:
+                    patch_data["pre_defined_nic_list"][i]["vpc_reference"] = {"kind": "vpc", "uuid": vm_first_nic_vpc_uuid}
+            else:
+                if len(vm["status"]["resources"]["nic_list"]) >= i + 1:
+                    patch_data["pre_defined_nic_list"][i]["subnet_reference"]["uuid"]=vm["status"]["resources"]["nic_list"][i]["subnet_reference"]["uuid"]
+                    # Update VPC reference if it exists (for VPC-based subnets)
+                    if vm["status"]["resources"]["nic_list"][i].get("vpc_reference"):
+                        patch_data["pre_defined_nic_list"][i]["vpc_reference"]["uuid"] = vm["status"]["resources"]["nic_list"][i]["vpc_reference"].get("uuid", "")
                 else:
-                    if len(vm["status"]["resources"]["nic_list"]) >= i + 1:
-                        patch_data["pre_defined_nic_list"][i]["subnet_reference"]["uuid"]=vm["status"]["resources"]["nic_list"][i]["subnet_reference"]["uuid"]
-                        # Update VPC reference if it exists (for VPC-based subnets)
-                        if vm["status"]["resources"]["nic_list"][i].get("vpc_reference"):
-                            patch_data["pre_defined_nic_list"][i]["vpc_reference"]["uuid"] = vm["status"]["resources"]["nic_list"][i]["vpc_reference"].get("uuid", "")
-                    else:
-                        patch_data["pre_defined_nic_list"][i]["subnet_reference"]["uuid"] = vm_first_nic_subnet_uuid
-                        # Update VPC reference if it exists (for VPC-based subnets)
-                        if vm_first_nic_vpc_uuid:
-                            patch_data["pre_defined_nic_list"][i]["vpc_reference"]["uuid"] = vm_first_nic_vpc_uuid
-        application.active_app_profile_instance.intent_spec = ujson.dumps(app_intent_spec_dict)
-        application.active_app_profile_instance.save()
-        application.save()
-
-def chunked_iterable(iterable, size):
-    """Yield successive chunks from an iterable."""
-    it = iter(iterable)
-    while True:
-        chunk = list(islice(it, size))
-        if not chunk:
-            break
-        yield chunk
+                    patch_data["pre_defined_nic_list"][i]["subnet_reference"]["uuid"] = vm_first_nic_subnet_uuid
+                    # Update VPC reference if it exists (for VPC-based subnets)
+                    if vm_first_nic_vpc_uuid:
+                        patch_data["pre_defined_nic_list"][i]["vpc_reference"]["uuid"] = vm_first_nic_vpc_uuid
+    application.active_app_profile_instance.intent_spec = ujson.dumps(app_intent_spec_dict)
+    write_behind.mark(application.active_app_profile_instance, owners)
+    write_behind.mark(application, owners)
+
+def group_by_application(vm_uuid_map, nse_index):
+    """
+    Group vm_uuid_map items by application, returns a list of [(vm_uuid, mapped_uuid), ...] per application.
+    VMs keep their relative order; VMs without substrate element or application form a group of their own.
+    """
+    groups = OrderedDict()
+    for vm_uuid, mapped_uuid in vm_uuid_map.items():
+        group_key = vm_uuid
+        NSE = nse_index.get(vm_uuid) or nse_index.get(mapped_uuid)
+        if NSE:
+            try:
+                group_key = str(get_application(NSE.app_profile_instance_reference).uuid)
+            except Exception:
+                pass
+        groups.setdefault(group_key, []).append((vm_uuid, mapped_uuid))
+    return list(groups.values())
+
+class BatchSizer(object):
+    """
+    Batch size of update_substrates.
+    With auto tune the size is moved toward the size whose flush (model saves + flush_session())
+    takes target_flush_seconds, based on the flush time per VM measured for the last batch.
+    """
+    MIN_BATCH_SIZE = 10
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, batch_size, auto_tune=False, target_flush_seconds=TARGET_FLUSH_SECONDS):
+        self.batch_size = batch_size
+        self.auto_tune = auto_tune
+        self.target_flush_seconds = target_flush_seconds
+
+    def record_flush(self, batch_len, seconds):
+        log.info("Flushed %d VMs in %.2fs", batch_len, seconds)
+        if not self.auto_tune or not batch_len or seconds <= 0:
+            return
+        wanted = batch_len * self.target_flush_seconds / seconds
+        # Move at most 2x per batch so a single slow flush does not swing the size too far
+        wanted = max(self.batch_size / 2.0, min(self.batch_size * 2.0, wanted))
+        new_batch_size = int(max(self.MIN_BATCH_SIZE, min(self.MAX_BATCH_SIZE, wanted)))
+        if new_batch_size != self.batch_size:
+            log.info("Auto tune: batch size %d -> %d (target flush %.1fs)", self.batch_size, new_batch_size, self.target_flush_seconds)
+            self.batch_size = new_batch_size
+
+def fetch_vms(executor, batch, vm_index):
+    """Submit destination VM GETs of a batch, skipping VMs already in vm_index, returns {vm_uuid: future}"""
+    return {
+        vm_uuid: executor.submit(get_vm, dest_client, mapped_uuid)
+        for vm_uuid, mapped_uuid in batch if mapped_uuid not in vm_index
+    }
+
+def prefetched_batches(executor, groups, sizer, vm_index):
+    """
+    Yield (batch, fetches) with batches of about sizer.batch_size VMs made of whole application groups,
+    an application is never split.
+    A batch is cut only when the caller asks for it, after the previous batch was flushed, so an auto
+    tuned size applies to the very next batch. Meanwhile the VMs of about one batch ahead are already
+    being fetched, so HTTP latency overlaps with the substrate updates and flush of the current batch.
+    """
+    groups = iter(groups)
+    # (group, fetches) of application groups whose VMs are being fetched ahead
+    lookahead = deque()
 
-def update_substrates(vm_uuid_map, batch_size=100):
+    def fetch_ahead():
+        queued = sum(len(group) for group, _ in lookahead)
+        while queued < sizer.batch_size:
+            group = next(groups, None)
+            if group is None:
+                return
+            lookahead.append((group, fetch_vms(executor, group, vm_index)))
+            queued += len(group)
+
+    fetch_ahead()
+    while lookahead:
+        batch = []
+        fetches = {}
+        while lookahead and (not batch or len(batch) + len(lookahead[0][0]) <= sizer.batch_size):
+            group, group_fetches = lookahead.popleft()
+            batch.extend(group)
+            fetches.update(group_fetches)
+        # Start fetching the following VMs before handing out this batch
+        fetch_ahead()
+        yield batch, fetches
+
+def update_substrates(vm_uuid_map, nse_index, batch_size=BATCH_SIZE, concurrency=VM_FETCH_CONCURRENCY,
+                      auto_tune=AUTO_TUNE_BATCH, target_flush_seconds=TARGET_FLUSH_SECONDS, vm_index=None):
+    """
+    Relink the VMs of vm_uuid_map in batches, returns (processed, updated, failed).
+    vm_index and the subnet cache are loaded here unless the caller (a --workers parent) already did.
+    """
     dest_account_uuid_map = get_account_uuid_map()
     total = len(vm_uuid_map)
     processed = 0
     updated = 0
     failed = 0
-    log.info("Starting substrate update for %d VMs.", total)
-
-    for batch_num, batch in enumerate(chunked_iterable(vm_uuid_map.items(), batch_size), 1):
-        log.info("=== Starting batch %d (%d VMs) ===", batch_num, len(batch))
-        batch_updated = 0
-        batch_failed = 0
-
-        start_index = (batch_num - 1) * batch_size
-        for idx, (vm_uuid, mapped_uuid) in enumerate(batch, 1):
-            global_index = start_index + idx
-            log.info("Processing VM %d of %d (batch %d, item %d): %s", global_index, total, batch_num, idx, vm_uuid)
-            processed += 1
+    log.info("Starting substrate update for %d VMs (fetch concurrency %d).", total, concurrency)
+    if not subnet_cache.vpc_by_subnet:
+        try:
+            subnet_cache.prefetch()
+        except Exception as e:
+            log.warning("Subnet prefetch failed, falling back to per subnet lookups: %s", e)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if vm_index is None:
             try:
-                vm = get_vm(dest_base_url, dest_pc_auth, mapped_uuid)
+                vm_index = load_vm_index(dest_client, executor, vm_uuid_map.values())
             except Exception as e:
-                log.warning("Failed to get VM %s: %s", vm_uuid, e)
-                failed += 1
-                batch_failed += 1
-                continue
+                log.warning("Bulk VM load failed, falling back to per VM fetch: %s", e)
+                vm_index = {}
+        sizer = BatchSizer(batch_size, auto_tune, target_flush_seconds)
+        groups = group_by_application(vm_uuid_map, nse_index)
+        for batch_num, (batch, fetches) in enumerate(prefetched_batches(executor, groups, sizer, vm_index), 1):
+            log.info("=== Starting batch %d (%d VMs) ===", batch_num, len(batch))
+            batch_updated = 0
+            batch_failed = 0
+            # application uuid -> (application, last VM of the app in this batch)
+            batch_apps = OrderedDict()
+            # VMs relinked in this batch, by application uuid (None for VMs without application)
+            batch_done = OrderedDict()
+            # VMs of applications whose app level pass failed, left unflushed in the journal so --resume redoes them
+            unfinished = set()
 
-            if DRY_RUN:
-                log.info("[DRY RUN] Would update substrate info for VM '%s'", vm_uuid)
-                updated += 1
-                batch_updated += 1
-            else:
+            for idx, (vm_uuid, mapped_uuid) in enumerate(batch, 1):
+                global_index = processed + 1
+                log.info("Processing VM %d of %d (batch %d, item %d): %s", global_index, total, batch_num, idx, vm_uuid)
+                processed += 1
                 try:
-                    update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map)
-                    updated += 1
-                    batch_updated += 1
+                    vm = vm_index.pop(mapped_uuid, None) or fetches[vm_uuid].result()
                 except Exception as e:
-                    log.warning("Failed to update substrate of %s: %s", vm_uuid, e)
+                    log.warning("Failed to get VM %s: %s", vm_uuid, e)
                     failed += 1
                     batch_failed += 1
+                    continue
+                journal_step(vm_uuid, "fetched", mapped_uuid)
 
-        if not DRY_RUN:
-            flush_session()  # ✅ flush after each batch
+                if DRY_RUN:
+                    log.info("[DRY RUN] Would update substrate info for VM '%s'", vm_uuid)
+                    updated += 1
+                    batch_updated += 1
+                else:
+                    try:
+                        application = update_substrate_info(vm_uuid, vm, dest_account_uuid_map, vm_uuid_map, nse_index)
+                        app_uuid = None
+                        if application is not None:
+                            app_uuid = str(application.uuid)
+                            batch_apps[app_uuid] = (application, vm)
+                        batch_done.setdefault(app_uuid, []).append(vm_uuid)
+                        updated += 1
+                        batch_updated += 1
+                    except Exception as e:
+                        log.warning("Failed to update substrate of %s: %s", vm_uuid, e)
+                        failed += 1
+                        batch_failed += 1
+
+            # Batches hold whole applications, so app level objects are rewritten once per app
+            for app_uuid, (application, vm) in batch_apps.items():
+                try:
+                    update_app_info(application, vm, dest_account_uuid_map, batch_done[app_uuid])
+                except Exception as e:
+                    log.warning("Failed to update app level config of application '%s': %s", application.name, e)
+                    unfinished.update(batch_done[app_uuid])
+
+            if not DRY_RUN:
+                flush_start = time.time()
+                failed_vm_uuids = write_behind.save_all()
+                flush_session()  # ✅ flush after each batch
+                # A VM with a failed save counts as failed, as it did when its objects were saved inline
+                save_failed = sum(vm_uuid in failed_vm_uuids for vm_uuids in batch_done.values() for vm_uuid in vm_uuids)
+                updated -= save_failed
+                batch_updated -= save_failed
+                failed += save_failed
+                batch_failed += save_failed
+                journal_flushed([vm_uuid for vm_uuids in batch_done.values() for vm_uuid in vm_uuids
+                                 if vm_uuid not in failed_vm_uuids and vm_uuid not in unfinished])
+                sizer.record_flush(len(batch), time.time() - flush_start)
 
-        log.info("=== Finished batch %d: %d updated, %d failed ===", batch_num, batch_updated, batch_failed)
-        time.sleep(0.1)  # optional throttle
-        gc.collect()     # optional memory cleanup
+            log.info("=== Finished batch %d: %d updated, %d failed ===", batch_num, batch_updated, batch_failed)
+            gc.collect()     # optional memory cleanup
 
+    log.info("Subnet VPC cache: %d hits, %d misses", subnet_cache.hits, subnet_cache.misses)
+    log.info("Model saves: %d saved, %d avoided by coalescing", write_behind.saved, write_behind.avoided)
     log.info("Done with updating substrates")
     return processed, updated, failed
 
 
-def update_app_project(vm_uuid_map):
-    app_names = set()
+def update_app_project(vm_uuid_map, nse_index):
+    app_uuids = OrderedDict()
+    checked_app_uuids = set()
     app_kind = "app"
     missing_app_uuids = []
     for instance_id in vm_uuid_map.keys():
         try:
-            NSE = model.NutanixSubstrateElement.query(instance_id=vm_uuid_map[instance_id], deleted=False)
+            NSE = nse_index.get(vm_uuid_map[instance_id])
             if NSE:
-                NSE = NSE[0]
                 try:
-                    app_profile_instance = model.AppProfileInstance.get_object(NSE.app_profile_instance_reference)
-                    application = app_profile_instance.application
+                    application = get_application(NSE.app_profile_instance_reference)
                 except Exception as e:
                     log.warning("Could not find application for AppProfileInstance reference '%s': %s", NSE.app_profile_instance_reference, e)
                     missing_app_uuids.append(NSE.app_profile_instance_reference)
                     continue
                 app_name = application.name
                 app_uuid = application.uuid
+                # Apps have several VMs, check each app's project once
+                if str(app_uuid) in checked_app_uuids:
+                    continue
+                checked_app_uuids.add(str(app_uuid))
                 entity_cap = EntityCapability(kind_name=app_kind, kind_id=str(app_uuid))
                 if entity_cap.project_name == SRC_PROJECT:
-                    app_names.add(app_name)
+                    app_uuids[str(app_uuid)] = app_name
         except Exception as e:
             log.warning("Error processing instance_id %s: %s", instance_id, e)
             continue
 
-    for app_name in app_names:
-        if DRY_RUN:
+    if DRY_RUN:
+        for app_name in app_uuids.values():
             log.info("[DRY RUN] Would change project for app '%s' to '%s'", app_name, DEST_PROJECT)
-        else:
-            change_project(app_name, DEST_PROJECT)
+    elif app_uuids:
+        change_projects(list(app_uuids.keys()), DEST_PROJECT)
     if missing_app_uuids:
         log.warning("The following AppProfileInstance references could not be processed (missing or error): %s", missing_app_uuids)
 
-def get_recovery_plan_jobs_list(base_url, auth, offset):
-    method = 'POST'
-    url = base_url + "/recovery_plan_jobs/list"
+def get_recovery_plan_jobs_list(client, offset):
     payload = {"length": LENGTH, "offset": offset}
-    resp = requests.request(
-            method,
-            url,
-            data=json.dumps(payload),
-            headers=headers,
-            auth=(auth["username"], auth["password"]),
-            verify=False
-    )
+    resp = client.post("/recovery_plan_jobs/list", payload)
     if resp.ok:
         resp_json = resp.json()
         return resp_json["entities"], resp_json["metadata"]["total_matches"]
@@ -451,16 +871,8 @@ def get_recovery_plan_jobs_list(base_url, auth, offset):
         log.info('Response: {}'.format(json.dumps(json.loads(resp.content), indent=4)))
         raise Exception("Failed to get recovery plan jobs list.")
 
-def get_recovery_plan_job_execution_status(base_url, auth, job_uuid):
-    method = 'GET'
-    url = base_url + "/recovery_plan_jobs/{0}/execution_status".format(job_uuid)
-    resp = requests.request(
-            method,
-            url,
-            headers=headers,
-            auth=(auth["username"], auth["password"]),
-            verify=False
-    )
+def get_recovery_plan_job_execution_status(client, job_uuid):
+    resp = client.get("/recovery_plan_jobs/{0}/execution_status".format(job_uuid))
     if resp.ok:
         resp_json = resp.json()
         return resp_json
@@ -470,36 +882,419 @@ def get_recovery_plan_job_execution_status(base_url, auth, job_uuid):
         log.info('Response: {}'.format(json.dumps(json.loads(resp.content), indent=4)))
         raise Exception("Failed to get recovery plan jobs {0} exucution status.".format(job_uuid))
 
-def get_vm_source_dest_uuid_map():
+def is_completed_failover_job(entity):
+    return (
+        entity["status"]["resources"]["execution_parameters"]["action_type"] in ["MIGRATE", "FAILOVER"] and
+        (
+            entity["status"]["execution_status"]["status"] == "COMPLETED" or
+            entity["status"]["execution_status"]["status"] == "COMPLETED_WITH_WARNING"
+        )
+    )
+
+def get_recovery_plan_job_uuids(client, executor):
+    """
+    Get uuids of completed MIGRATE/FAILOVER recovery plan jobs, in list order.
+    The first page gives total_matches, the remaining pages are fetched concurrently.
+    """
+    entities, total_matches = get_recovery_plan_jobs_list(client, 0)
+    pages = [entities]
+    offsets = range(LENGTH, total_matches, LENGTH)
+    pages.extend(entities for entities, _ in executor.map(lambda offset: get_recovery_plan_jobs_list(client, offset), offsets))
+    return [entity["metadata"]["uuid"] for entities in pages for entity in entities if is_completed_failover_job(entity)]
+
+def get_job_vm_uuid_map(client, job_uuid):
+    """Get source -> destination vm uuid map of a recovery plan job"""
+    job_vm_uuid_map = {}
+    job_execution_status = get_recovery_plan_job_execution_status(client, job_uuid)
+    step_execution_status_list = job_execution_status["operation_status"]["step_execution_status_list"]
+    for step_execution_status_src in step_execution_status_list:
+        if step_execution_status_src["operation_type"] == "ENTITY_RECOVERY" :
+            src_vm_uuid = step_execution_status_src["any_entity_reference_list"][0]["uuid"]
+            dest_vm_uuid = step_execution_status_src["recovered_entity_info_list"][0]["recovered_entity_info"].get("entity_uuid")
+            job_vm_uuid_map[src_vm_uuid] = dest_vm_uuid
+    return job_vm_uuid_map
+
+def load_vm_map_state(state_file):
+    """
+    Load checkpointed recovery plan jobs, returns {job_uuid: job_vm_uuid_map}.
+    Each line of the state file is one processed job: {"job_uuid": ..., "vm_map": {...}}
+    """
+    job_vm_uuid_maps = {}
+    if not state_file or not os.path.exists(state_file):
+        return job_vm_uuid_maps
+    with open(state_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partially written last line of an interrupted run
+                log.warning("Ignoring corrupt line in state file '%s'", state_file)
+                continue
+            job_vm_uuid_maps[record["job_uuid"]] = record["vm_map"]
+    log.info("Loaded %d processed recovery plan jobs from '%s'.", len(job_vm_uuid_maps), state_file)
+    return job_vm_uuid_maps
+
+def iter_job_vm_uuid_maps(executor, state_file=VM_MAP_STATE_FILE):
+    """
+    Yield (job_uuid, job_vm_uuid_map) of completed MIGRATE/FAILOVER recovery plan jobs, in job list order.
+    Jobs found in state_file are not fetched again, new ones are fetched concurrently and checkpointed
+    as they are yielded.
+    """
+    job_vm_uuid_maps = load_vm_map_state(state_file)
+    recovery_plan_jobs_list = get_recovery_plan_job_uuids(dest_client, executor)
+    new_jobs = [job_uuid for job_uuid in recovery_plan_jobs_list if job_uuid not in job_vm_uuid_maps]
+    log.info("Found %d completed MIGRATE/FAILOVER recovery plan jobs, %d not processed before.",
+             len(recovery_plan_jobs_list), len(new_jobs))
+    new_job_vm_uuid_maps = executor.map(lambda job_uuid: get_job_vm_uuid_map(dest_client, job_uuid), new_jobs)
+    state = open(state_file, "a") if state_file else None
+    try:
+        for job_uuid in recovery_plan_jobs_list:
+            if job_uuid in job_vm_uuid_maps:
+                yield job_uuid, job_vm_uuid_maps[job_uuid]
+                continue
+            job_vm_uuid_map = next(new_job_vm_uuid_maps)
+            if state:
+                state.write(json.dumps({"job_uuid": job_uuid, "vm_map": job_vm_uuid_map}) + "\n")
+                state.flush()
+            yield job_uuid, job_vm_uuid_map
+    finally:
+        if state:
+            state.close()
+
+def get_vm_source_dest_uuid_map(concurrency=RECOVERY_JOB_CONCURRENCY, state_file=VM_MAP_STATE_FILE):
     vm_source_dest_uuid_map = {}
-    recovery_plan_jobs_list = []
-    total_matches = 1
-    offset = 0
-    while offset < total_matches:
-        entities, total_matches = get_recovery_plan_jobs_list(dest_base_url, dest_pc_auth, offset)
-        for entity in entities:
-            if (
-                entity["status"]["resources"]["execution_parameters"]["action_type"] in ["MIGRATE", "FAILOVER"] and
-                (
-                    entity["status"]["execution_status"]["status"] == "COMPLETED" or
-                    entity["status"]["execution_status"]["status"] == "COMPLETED_WITH_WARNING"
-                )
-            ):
-                recovery_plan_jobs_list.append(entity["metadata"]["uuid"])
-        offset += LENGTH
-
-    for recovery_plan_job in recovery_plan_jobs_list:
-        job_execution_status = get_recovery_plan_job_execution_status(dest_base_url, dest_pc_auth, recovery_plan_job)
-        step_execution_status_list = job_execution_status["operation_status"]["step_execution_status_list"]
-        for step_execution_status_src in step_execution_status_list:
-            if step_execution_status_src["operation_type"] == "ENTITY_RECOVERY" :
-                step_uuid = step_execution_status_src["step_uuid"]
-                src_vm_uuid = step_execution_status_src["any_entity_reference_list"][0]["uuid"]
-                dest_vm_uuid = step_execution_status_src["recovered_entity_info_list"][0]["recovered_entity_info"].get("entity_uuid")
-                vm_source_dest_uuid_map[src_vm_uuid] = dest_vm_uuid
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Merge in job list order, so later jobs override earlier ones exactly as a serial crawl would
+        for _, job_vm_uuid_map in iter_job_vm_uuid_maps(executor, state_file):
+            vm_source_dest_uuid_map.update(job_vm_uuid_map)
 
     return vm_source_dest_uuid_map
 
+# Marks the end of a pipeline queue
+PIPELINE_DONE = object()
+
+class PipelineStats(object):
+    """Item counters of the pipeline stages, logged with the queue depths every interval seconds"""
+    STAGES = ("jobs", "pairs", "fetched", "updated", "flushed")
+
+    def __init__(self, interval=PIPELINE_LOG_INTERVAL):
+        self.interval = interval
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self.last_counts = dict(self.counts)
+        self.last_log = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, stage, count=1):
+        with self.lock:
+            self.counts[stage] += count
+
+    def log(self, pair_queue, vm_queue, force=False):
+        now = time.time()
+        if not force and now - self.last_log < self.interval:
+            return
+        with self.lock:
+            counts = dict(self.counts)
+        elapsed = max(now - self.last_log, 0.001)
+        rates = ", ".join("%s %d (%.1f/s)" % (stage, counts[stage], (counts[stage] - self.last_counts[stage]) / elapsed)
+                          for stage in self.STAGES)
+        log.info("Pipeline: %s | queued pairs %d, queued VMs %d", rates, pair_queue.qsize(), vm_queue.qsize())
+        self.last_counts = counts
+        self.last_log = now
+
+def crawl_stage(pair_queue, stats, fetch_workers, errors, concurrency=RECOVERY_JOB_CONCURRENCY, state_file=VM_MAP_STATE_FILE):
+    """
+    Pipeline stage 1: crawl recovery plan jobs and queue (seq, source vm uuid, destination vm uuid).
+    seq follows job list order, so the consumer can let later jobs override earlier ones.
+    """
+    seq = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _, job_vm_uuid_map in iter_job_vm_uuid_maps(executor, state_file):
+                stats.add("jobs")
+                for vm_uuid, mapped_uuid in job_vm_uuid_map.items():
+                    seq += 1
+                    pair_queue.put((seq, vm_uuid, mapped_uuid))
+                    stats.add("pairs")
+    except Exception as e:
+        log.error("Recovery plan job crawl failed: %s", e)
+        errors.append(e)
+    finally:
+        for _ in range(fetch_workers):
+            pair_queue.put(PIPELINE_DONE)
+
+def fetch_stage(pair_queue, vm_queue, stats):
+    """Pipeline stage 2: fetch the destination VM of queued pairs, queues (seq, vm_uuid, mapped_uuid, vm, error)"""
+    while True:
+        item = pair_queue.get()
+        if item is PIPELINE_DONE:
+            vm_queue.put(PIPELINE_DONE)
+            return
+        seq, vm_uuid, mapped_uuid = item
+        vm, error = None, None
+        try:
+            vm = get_vm(dest_client, mapped_uuid)
+        except Exception as e:
+            error = e
+        vm_queue.put((seq, vm_uuid, mapped_uuid, vm, error))
+        stats.add("fetched")
+
+def run_pipeline(batch_size=BATCH_SIZE, concurrency=VM_FETCH_CONCURRENCY, auto_tune=AUTO_TUNE_BATCH,
+                 target_flush_seconds=TARGET_FLUSH_SECONDS, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    Streaming variant of get_vm_source_dest_uuid_map + update_substrates.
+    Background threads crawl recovery plan jobs and fetch destination VMs into bounded queues while
+    the main thread relinks VMs as they arrive and flushes every batch_size VMs, so the first VMs are
+    relinked while later jobs are still being crawled. Store work stays on the main thread.
+    A VM seen in several jobs counts once, with the outcome of its latest job's pair.
+    An application's VMs may land in different batches, so the app level pass runs once per
+    application with its last VM after the crawl, flushed in chunks of batch_size applications.
+    Returns (processed, updated, failed).
+    """
+    pair_queue = queue.Queue(maxsize=queue_size)
+    vm_queue = queue.Queue(maxsize=queue_size)
+    stats = PipelineStats()
+    errors = []
+    threads = [threading.Thread(target=crawl_stage, args=(pair_queue, stats, concurrency, errors), name="crawl", daemon=True)]
+    threads.extend(threading.Thread(target=fetch_stage, args=(pair_queue, vm_queue, stats), name=f"fetch-{i}", daemon=True)
+                   for i in range(concurrency))
+    for thread in threads:
+        thread.start()
+
+    # Runs while the first jobs are crawled
+    dest_account_uuid_map = get_account_uuid_map()
+    nse_index = SubstrateElementIndex()
+    try:
+        subnet_cache.prefetch()
+    except Exception as e:
+        log.warning("Subnet prefetch failed, falling back to per subnet lookups: %s", e)
+
+    sizer = BatchSizer(batch_size, auto_tune, target_flush_seconds)
+    # source vm uuid -> (seq, destination vm uuid) of the latest job seen for the VM
+    vm_uuid_map = {}
+    # source vm uuid -> "updated" or "failed", of the latest pair of the VM. A pair of an older job that
+    # arrived first is superseded by the later one, so only the latest pair counts
+    outcomes = OrderedDict()
+    # application uuid -> (application, last VM of the app)
+    pending_apps = OrderedDict()
+    # VMs relinked so far by application uuid, owners of the app level objects
+    done = OrderedDict()
+    batch_vm_uuids = []
+
+    # source vm uuid -> application uuid of its latest relink, None for VMs without application
+    vm_apps = {}
+    # Pairs that would relink a VM the journal has flushed to another destination, held back until the
+    # crawl is done, so a stale pair never replaces the journal row of the VM's current mapping
+    deferred = []
+
+    def flush(vm_uuids, flushed_vm_uuids, app_count=0):
+        """Flush the session, flushed_vm_uuids are journaled as flushed unless their save failed"""
+        if not DRY_RUN:
+            flush_start = time.time()
+            failed_vm_uuids = write_behind.save_all()
+            flush_session()
+            # A VM with a failed save counts as failed, as it does in update_substrates
+            for vm_uuid in failed_vm_uuids:
+                if outcomes.get(vm_uuid) == "updated":
+                    outcomes[vm_uuid] = "failed"
+            journal_flushed([vm_uuid for vm_uuid in flushed_vm_uuids if outcomes.get(vm_uuid) == "updated"])
+            if app_count:
+                log.info("Flushed app level config of %d applications in %.2fs", app_count, time.time() - flush_start)
+            else:
+                sizer.record_flush(len(vm_uuids), time.time() - flush_start)
+        if not app_count:
+            stats.add("flushed", len(vm_uuids))
+        gc.collect()
+
+    def flush_batch():
+        # VMs of an application are journaled as flushed with the app level pass
+        flush(batch_vm_uuids, [vm_uuid for vm_uuid in batch_vm_uuids if vm_apps.get(vm_uuid) is None])
+        del batch_vm_uuids[:]
+
+    def relink(item):
+        seq, vm_uuid, mapped_uuid, vm, error = item
+        log.info("Processing VM %s -> %s (pair %d)", vm_uuid, mapped_uuid, seq)
+        vm_apps[vm_uuid] = None
+        if error is not None:
+            log.warning("Failed to get VM %s: %s", vm_uuid, error)
+            outcomes[vm_uuid] = "failed"
+        elif DRY_RUN:
+            log.info("[DRY RUN] Would update substrate info for VM '%s'", vm_uuid)
+            outcomes[vm_uuid] = "updated"
+        else:
+            journal_step(vm_uuid, "fetched", mapped_uuid)
+            try:
+                application = update_substrate_info(vm_uuid, vm, dest_account_uuid_map, {vm_uuid: mapped_uuid}, nse_index)
+                if application is not None:
+                    app_uuid = str(application.uuid)
+                    vm_apps[vm_uuid] = app_uuid
+                    pending_apps[app_uuid] = (application, vm)
+                    if vm_uuid not in done.setdefault(app_uuid, []):
+                        done[app_uuid].append(vm_uuid)
+                outcomes[vm_uuid] = "updated"
+            except Exception as e:
+                log.warning("Failed to update substrate of %s: %s", vm_uuid, e)
+                outcomes[vm_uuid] = "failed"
+        stats.add("updated")
+        batch_vm_uuids.append(vm_uuid)
+        if len(batch_vm_uuids) >= sizer.batch_size:
+            flush_batch()
+
+    running = concurrency
+    while running:
+        try:
+            item = vm_queue.get(timeout=stats.interval)
+        except queue.Empty:
+            stats.log(pair_queue, vm_queue)
+            continue
+        if item is PIPELINE_DONE:
+            running -= 1
+            continue
+        seq, vm_uuid, mapped_uuid = item[:3]
+        if vm_uuid in vm_uuid_map and vm_uuid_map[vm_uuid][0] > seq:
+            log.info("Skipping VM %s from an older recovery plan job", vm_uuid)
+            continue
+        vm_uuid_map[vm_uuid] = (seq, mapped_uuid)
+        flushed_uuid = journal_flushed_mapped_uuid(vm_uuid)
+        if flushed_uuid == mapped_uuid:
+            log.info("Skipping VM %s, already flushed by an earlier run", vm_uuid)
+            continue
+        if flushed_uuid is not None:
+            # May be an older job's pair arriving first, the crawl decides which pair is the latest
+            deferred.append(item)
+            continue
+        relink(item)
+        stats.log(pair_queue, vm_queue)
+
+    for thread in threads:
+        thread.join()
+    for item in deferred:
+        seq, vm_uuid, mapped_uuid = item[:3]
+        if vm_uuid_map[vm_uuid][0] != seq:
+            log.info("Skipping VM %s from an older recovery plan job", vm_uuid)
+            continue
+        relink(item)
+    if batch_vm_uuids:
+        flush_batch()
+
+    # Every VM is in by now, so each application's last VM is known
+    chunk_apps = 0
+    chunk_vm_uuids = []
+    for app_uuid, (application, vm) in pending_apps.items():
+        chunk_apps += 1
+        try:
+            update_app_info(application, vm, dest_account_uuid_map, done[app_uuid])
+            # A VM relinked again later under another application is journaled with that one
+            chunk_vm_uuids.extend(vm_uuid for vm_uuid in done[app_uuid] if vm_apps.get(vm_uuid) == app_uuid)
+        except Exception as e:
+            log.warning("Failed to update app level config of application '%s': %s", application.name, e)
+        if chunk_apps >= sizer.batch_size:
+            flush([], chunk_vm_uuids, chunk_apps)
+            chunk_apps = 0
+            chunk_vm_uuids = []
+    if chunk_apps:
+        flush([], chunk_vm_uuids, chunk_apps)
+    stats.log(pair_queue, vm_queue, force=True)
+    log.info("Model saves: %d saved, %d avoided by coalescing", write_behind.saved, write_behind.avoided)
+    if errors:
+        # Everything relinked so far is flushed, a rerun picks up the remaining jobs
+        raise errors[0]
+    log.info("Done with updating substrates")
+    updated = sum(outcome == "updated" for outcome in outcomes.values())
+    return len(outcomes), updated, len(outcomes) - updated
+
+def shard_by_application(vm_uuid_map, nse_index, shards):
+    """
+    Split vm_uuid_map into at most shards maps of whole applications, so no two shards touch the same
+    clone blueprint or patches. Each application goes to the currently smallest shard.
+    """
+    shard_maps = [OrderedDict() for _ in range(max(1, shards))]
+    for group in group_by_application(vm_uuid_map, nse_index):
+        shard_map = min(shard_maps, key=len)
+        shard_map.update(group)
+    return [shard_map for shard_map in shard_maps if shard_map]
+
+def run_counters(processed, updated, failed):
+    """Counters of this process for the summary, worker counters are summed into the parent's"""
+    return OrderedDict([
+        ("processed", processed),
+        ("updated", updated),
+        ("failed", failed),
+        ("subnet_hits", subnet_cache.hits),
+        ("subnet_misses", subnet_cache.misses),
+        ("app_cache_hits", app_cache.hits),
+        ("app_cache_misses", app_cache.misses),
+        ("app_cache_evictions", app_cache.evictions),
+        ("saves_avoided", write_behind.avoided),
+        ("category_lookups_saved", helper.category_lookups_saved),
+        ("retries", dest_client.retries),
+        ("throttled", dest_client.throttled),
+    ])
+
+def update_substrates_worker(vm_uuid_map, nse_uuids, vm_index, vpc_by_subnet, concurrency, pc_max_concurrency,
+                             batch_size, auto_tune, target_flush_seconds, flush_parallelism, bulk_size, journal_file=None):
+    """
+    Entry point of a --workers process: relink one application shard in its own green DB session.
+    VMs, subnets and substrate element uuids come from the parent, fetch and PC concurrency are
+    this worker's share of the totals.
+    """
+    init_contexts(flush_parallelism, bulk_size)
+    dest_client.limiter.set_maximum(pc_max_concurrency)
+    subnet_cache.vpc_by_subnet.update(vpc_by_subnet)
+    # The parent already reset or filtered the journal, workers only add to it
+    try:
+        open_journal(journal_file, resume=True)
+    except Exception as e:
+        log.warning("Could not open journal '%s', this shard runs without it: %s", journal_file, e)
+    nse_index = load_substrate_elements(nse_uuids)
+    processed, updated, failed = update_substrates(vm_uuid_map, nse_index, batch_size, concurrency, auto_tune=auto_tune,
+                                                   target_flush_seconds=target_flush_seconds, vm_index=vm_index)
+    return run_counters(processed, updated, failed)
+
+def update_substrates_sharded(vm_uuid_map, nse_index, workers, args):
+    """
+    Run update_substrates over application shards in a pool of spawned processes, so the JSON work
+    of update_substrate_info uses several cores. Each worker opens its own session.
+    The destination VM inventory and subnets are loaded once here and each worker gets its slice.
+    VM_FETCH_CONCURRENCY and PC_MAX_CONCURRENCY are split across the workers, so together they
+    put no more load on the PC than a single process. Returns the summed counters of the workers.
+    """
+    shards = shard_by_application(vm_uuid_map, nse_index, workers)
+    log.info("Relinking %d VMs in %d worker processes (shard sizes %s).", len(vm_uuid_map), len(shards),
+             [len(shard) for shard in shards])
+    try:
+        subnet_cache.prefetch()
+    except Exception as e:
+        log.warning("Subnet prefetch failed, workers fall back to per subnet lookups: %s", e)
+    with ThreadPoolExecutor(max_workers=VM_FETCH_CONCURRENCY) as executor:
+        try:
+            vm_index = load_vm_index(dest_client, executor, vm_uuid_map.values())
+        except Exception as e:
+            log.warning("Bulk VM load failed, workers fall back to per VM fetch: %s", e)
+            vm_index = {}
+    concurrency = max(1, VM_FETCH_CONCURRENCY // len(shards))
+    pc_max_concurrency = max(1, helper.PC_MAX_CONCURRENCY // len(shards))
+    totals = OrderedDict.fromkeys(run_counters(0, 0, 0), 0)
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = []
+        for shard in shards:
+            instance_ids = set(shard.keys()) | set(mapped_uuid for mapped_uuid in shard.values() if mapped_uuid)
+            nse_uuids = {instance_id: str(nse_index[instance_id].uuid) for instance_id in instance_ids if instance_id in nse_index}
+            shard_vm_index = {mapped_uuid: vm_index[mapped_uuid] for mapped_uuid in shard.values() if mapped_uuid in vm_index}
+            futures.append(executor.submit(
+                update_substrates_worker, dict(shard), nse_uuids, shard_vm_index, subnet_cache.vpc_by_subnet,
+                concurrency, pc_max_concurrency, args.batch_size, args.auto_tune_batch, args.target_flush_seconds,
+                args.flush_parallelism, args.bulk_size, journal.path if journal else None))
+        for shard_num, (shard, future) in enumerate(zip(shards, futures), 1):
+            try:
+                counters = future.result()
+            except Exception as e:
+                # What the worker flushed before failing stays relinked, the rest of its shard counts as failed
+                log.error("Worker %d failed: %s", shard_num, e)
+                counters = {"processed": len(shard), "failed": len(shard)}
+            for key, value in counters.items():
+                totals[key] += value
+    return totals
+
 # Uncomment if you want to test the script for a specific set of VMs
 #def main():
 #    start_time = time.strftime('%Y-%m-%d %H:%M:%S')
@@ -512,8 +1307,9 @@ def get_vm_source_dest_uuid_map():
 #        if not vm_uuid_map:
 #            log.info("No VMs to process after filtering.")
 #        init_contexts()
-#        processed, updated, failed = update_substrates(vm_uuid_map)
-#        # update_app_project(vm_uuid_map)  # Uncomment if you want to update app projects too
+#        nse_index = load_substrate_element_index(vm_uuid_map)
+#        processed, updated, failed = update_substrates(vm_uuid_map, nse_index)
+#        # update_app_project(vm_uuid_map, nse_index)  # Uncomment if you want to update app projects too
 #    except Exception as e:
 #        log.error("Exception: %s", e)
 #        raise
@@ -527,31 +1323,80 @@ def get_vm_source_dest_uuid_map():
 #    print(f"  VMs failed:          {failed}")
 #    print("="*60)
 
-def main():
+def parse_args():
+    parser = argparse.ArgumentParser(description="Relink NCM Self-Service apps with failed over VMs")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="VMs per flush batch (env BATCH_SIZE, default 100)")
+    parser.add_argument("--auto-tune-batch", action="store_true", default=AUTO_TUNE_BATCH,
+                        help="adjust batch size toward --target-flush-seconds (env AUTO_TUNE_BATCH)")
+    parser.add_argument("--target-flush-seconds", type=float, default=TARGET_FLUSH_SECONDS,
+                        help="target flush time per batch for auto tune (env TARGET_FLUSH_SECONDS, default 5)")
+    parser.add_argument("--bulk-size", default=None,
+                        help="green session bulk_size (env CALM_BULK_SIZE, default from Calm config)")
+    parser.add_argument("--flush-parallelism", default=None,
+                        help="green session flush_parallelisation_factor (env CALM_FLUSH_PARALLELISATION_FACTOR, default from Calm config)")
+    parser.add_argument("--pipeline", action="store_true", default=PIPELINE,
+                        help="stream VMs from the recovery plan job crawl to the relink through bounded queues (env PIPELINE)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="worker processes relinking application shards, ignored with --pipeline (env WORKERS, default 1)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip VMs the journal (env JOURNAL_FILE) records as flushed by an earlier run, redo the rest")
+    return parser.parse_args()
+
+def main(args):
     start_time = time.strftime('%Y-%m-%d %H:%M:%S')
     try:
-        vm_uuid_map = get_vm_source_dest_uuid_map()
-        # log.info("VM UUID map: %s", vm_uuid_map)  # Uncomment for debugging
-        if not vm_uuid_map:
-            log.info("No VMs to process.")
-            return
-        init_contexts()
-        processed, updated, failed = update_substrates(vm_uuid_map)
-        update_substrates(vm_uuid_map)
-        # update_app_project(vm_uuid_map)  # Uncomment if you want to update app projects too
+        if open_journal(JOURNAL_FILE, args.resume):
+            log.info("Journaling VM progress to '%s'%s.", JOURNAL_FILE, " (resuming)" if args.resume else "")
+        elif args.resume:
+            log.warning("--resume ignored, no journal in dry run or with empty JOURNAL_FILE.")
+        if args.pipeline:
+            init_contexts(args.flush_parallelism, args.bulk_size)
+            processed, updated, failed = run_pipeline(args.batch_size, auto_tune=args.auto_tune_batch,
+                                                      target_flush_seconds=args.target_flush_seconds)
+            counters = run_counters(processed, updated, failed)
+        else:
+            vm_uuid_map = get_vm_source_dest_uuid_map()
+            # log.info("VM UUID map: %s", vm_uuid_map)  # Uncomment for debugging
+            if journal and args.resume:
+                vm_uuid_map = journal.pending(vm_uuid_map)
+            if not vm_uuid_map:
+                log.info("No VMs to process.")
+                return
+            init_contexts(args.flush_parallelism, args.bulk_size)
+            nse_index = load_substrate_element_index(vm_uuid_map)
+            if args.workers > 1:
+                counters = update_substrates_sharded(vm_uuid_map, nse_index, args.workers, args)
+            else:
+                processed, updated, failed = update_substrates(vm_uuid_map, nse_index, args.batch_size,
+                                                               auto_tune=args.auto_tune_batch,
+                                                               target_flush_seconds=args.target_flush_seconds)
+                counters = run_counters(processed, updated, failed)
+            # update_app_project(vm_uuid_map, nse_index)  # Uncomment if you want to update app projects too
     except Exception as e:
         log.error("Exception: %s", e)
         raise
+    print_summary(start_time, counters)
+
+def print_summary(start_time, counters):
     end_time = time.strftime('%Y-%m-%d %H:%M:%S')
     print("="*60)
     print("Summary:")
     print(f"  Start time: {start_time}")
     print(f"  End time:   {end_time}")
-    print(f"  Total VMs processed: {processed}")
-    print(f"  VMs updated:         {updated}")
-    print(f"  VMs failed:          {failed}")
+    print(f"  Total VMs processed: {counters['processed']}")
+    print(f"  VMs updated:         {counters['updated']}")
+    print(f"  VMs failed:          {counters['failed']}")
+    print(f"  Subnet cache hits:   {counters['subnet_hits']}")
+    print(f"  Subnet cache misses: {counters['subnet_misses']}")
+    print(f"  Application cache:   {counters['app_cache_hits']} hits, {counters['app_cache_misses']} misses, "
+          f"{counters['app_cache_evictions']} evictions")
+    print(f"  Model saves avoided: {counters['saves_avoided']}")
+    print(f"  Category lookups saved: {counters['category_lookups_saved']}")
+    print(f"  PC call retries:     {counters['retries']} ({counters['throttled']} throttled)")
     print("="*60)
 
 if __name__ == "__main__":
+    args = parse_args()
     print_header()
-    main()
+    main(args)
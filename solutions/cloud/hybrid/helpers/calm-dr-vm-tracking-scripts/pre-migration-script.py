@@ -2,14 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import os
-import requests
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from calm.common.flags import gflags
-from helper import init_contexts, log, DRY_RUN
+from helper import init_contexts, get_pc_client, batch_requests, v3_path, fetch_projection, log, DRY_RUN, PC_BATCH_SIZE
 from calm.lib.model.store.idf.db import get_insights_db
 from calm.lib.proto import AbacEntityCapability
+try:
+    from calm.lib.proto import Application as ApplicationProto, NutanixSubstrateElement as NutanixSubstrateElementProto
+except ImportError:
+    # No IDF projection of these entities on this Calm version, full application objects are loaded instead
+    ApplicationProto = NutanixSubstrateElementProto = None
 from calm.common.project_util import ProjectUtil
 import calm.lib.model as model
 
@@ -22,14 +27,13 @@ if missing_env:
 dest_categorie_map = {}
 
 DEST_PC_IP = os.environ['DEST_PC_IP']
-PC_PORT = 9440
 LENGTH = 100
 DELETED_STATE = 'deleted'
 NUTANIX_VM = 'AHV_VM'
 SOURCE_PROJECT = os.environ['SOURCE_PROJECT_NAME']
+CATEGORY_CONCURRENCY = int(os.environ.get("CATEGORY_CONCURRENCY", "10"))
 
-dest_base_url = "https://{}:{}/api/nutanix/v3".format(DEST_PC_IP, str(PC_PORT))
-dest_pc_auth = {"username": os.environ['DEST_PC_USER'], "password": os.environ['DEST_PC_PASS']}
+dest_client = get_pc_client(DEST_PC_IP, os.environ['DEST_PC_USER'], os.environ['DEST_PC_PASS'])
 
 SYS_DEFINED_CATEGORY_KEY_LIST = [
     "ADGroup",
@@ -56,25 +60,14 @@ SYS_DEFINED_CATEGORY_KEY_LIST = [
     "VirtualNetworkType"
 ]
 
-headers = {'content-type': 'application/json', 'Accept': 'application/json'}
-
-def create_category_key(base_url, auth, key):
+def create_category_key(client, key):
     if DRY_RUN:
         log.info("[DRY RUN] Would create category key '%s'", key)
         return True
-    method = 'PUT'
-    url = base_url + "/categories/{}".format(key)
     payload = {
         "name": key
     }
-    resp = requests.request(
-        method,
-        url,
-        data=json.dumps(payload),
-        headers=headers,
-        auth=(auth["username"], auth["password"]),
-        verify=False
-    )
+    resp = client.put("/categories/{}".format(key), payload)
     if resp.ok:
         log.info(f"Successfully created category key '{key}'.")
         return True
@@ -84,39 +77,22 @@ def create_category_key(base_url, auth, key):
         log.warning('Response: {}'.format(json.dumps(json.loads(resp.content), indent=4)))
         raise Exception("Failed to create category key '{}'.".format(key))
 
-def is_category_key_present(base_url, auth, key):
-    method = 'GET'
-    url = base_url + "/categories/{}".format(key)
-    resp = requests.request(
-        method,
-        url,
-        headers=headers,
-        auth=(auth["username"], auth["password"]),
-        verify=False
-    )
+def is_category_key_present(client, key):
+    resp = client.get("/categories/{}".format(key))
     if resp.ok:
         return True
     else:
         return False
 
-def create_category_value(base_url, auth, key, value):
+def create_category_value(client, key, value):
     if DRY_RUN:
         log.info("[DRY RUN] Would create category value '%s' for key '%s'", value, key)
         return True
-    method = 'PUT'
-    url = base_url + "/categories/{}/{}".format(key, value)
     payload = {
         "value": value,
         "description": ""
     }
-    resp = requests.request(
-        method,
-        url,
-        data=json.dumps(payload),
-        headers=headers,
-        auth=(auth["username"], auth["password"]),
-        verify=False
-    )
+    resp = client.put("/categories/{}/{}".format(key, value), payload)
     if resp.ok:
         log.info(f"Successfully created category value '{value}' for key '{key}'.")
         return True
@@ -126,6 +102,31 @@ def create_category_value(base_url, auth, key, value):
         log.warning('Response: {}'.format(json.dumps(json.loads(resp.content), indent=4)))
         raise Exception("Failed to create category value '{}' for key '{}'.".format(value, key))
 
+def create_category_values_batch(client, key_values):
+    """
+    Create category values through v3 batch API, PC_BATCH_SIZE values per request.
+    Failed values are logged, returns the number of values created.
+    Args:
+        client(PCClient): client of the PC
+        key_values(list): (key, value) pairs to create
+    """
+    if DRY_RUN:
+        for key, value in key_values:
+            log.info("[DRY RUN] Would create category value '%s' for key '%s'", value, key)
+        return len(key_values)
+    api_requests = [
+        ("PUT", v3_path("categories", key, value), {"value": value, "description": ""})
+        for key, value in key_values
+    ]
+    created = 0
+    for (key, value), (status_code, response) in zip(key_values, batch_requests(client, api_requests)):
+        if status_code in [200, 201, 202]:
+            log.info(f"Successfully created category value '{value}' for key '{key}'.")
+            created += 1
+        else:
+            log.error("Failed to create category value '{}' for key '{}'. Status code: {}, Response: {}".format(value, key, status_code, response))
+    return created
+
 def get_application_uuids(project_name):
     project_handle = ProjectUtil()
     project_proto = project_handle.get_project_by_name(project_name)
@@ -139,61 +140,250 @@ def get_application_uuids(project_name):
         application_uuid_list.append(application[1][0])
     return application_uuid_list
 
+def list_all(client, path, payload):
+    """Page through a v3 list endpoint, returns all entities"""
+    entities = []
+    total_matches = 1
+    offset = 0
+    while offset < total_matches:
+        resp = client.post(path, dict(payload, length=LENGTH, offset=offset))
+        if not resp.ok:
+            log.warning("Failed to list '%s'. Status: %s, Response: %s", path, resp.status_code, resp.text)
+            raise Exception("Failed to list '{}'.".format(path))
+        resp_json = resp.json()
+        entities.extend(resp_json["entities"])
+        total_matches = resp_json["metadata"]["total_matches"]
+        offset += LENGTH
+    return entities
+
+def get_dest_categories(client, keys):
+    """
+    Get category inventory of the destination PC for the given keys, returns {key: set(values)}.
+    Keys not present on the PC are left out.
+    """
+    try:
+        dest_keys = set(entity["name"] for entity in list_all(client, "/categories/list", {"kind": "category"}))
+    except Exception as e:
+        log.warning("Could not list category keys, checking keys one by one: %s", e)
+        dest_keys = set(key for key in keys if is_category_key_present(client, key))
+    dest_categories = {}
+    for key in keys:
+        if key not in dest_keys:
+            continue
+        try:
+            values = list_all(client, "/categories/{}/list".format(key), {"kind": "category"})
+            dest_categories[key] = set(entity["value"] for entity in values)
+        except Exception as e:
+            # Unknown values are (re)created, PUT of an existing value is harmless
+            log.warning("Could not list values of category key %s: %s", key, e)
+            dest_categories[key] = set()
+    return dest_categories
+
+def add_categories(categories):
+    """Merge a substrate element categories json string into dest_categorie_map"""
+    if not categories:
+        return
+    category = json.loads(categories)
+    for key in category.keys():
+        value = category[key]
+        if key not in dest_categorie_map.keys():
+            dest_categorie_map[key] = []
+        if value not in dest_categorie_map[key]:
+            dest_categorie_map[key].append(value)
+
+def reference_uuid(reference):
+    """uuid string of a reference, as a model reference, a reference dict or a plain uuid"""
+    if isinstance(reference, dict):
+        reference = reference.get("uuid")
+    return str(getattr(reference, "uuid", reference))
+
+def get_app_profile_instances(app_uuids):
+    """
+    Resolve the active AppProfileInstance of the given applications with a paged IDF projection of the
+    application state and active app profile instance reference, no application object is loaded.
+    Returns ({app_profile_instance_uuid: app_uuid}, set of deleted app uuids). Applications the
+    projection does not return are in neither.
+    """
+    app_uuids = set(app_uuids)
+    profile_instances = {}
+    deleted_uuids = set()
+    for row in fetch_projection(ApplicationProto, ["state", "active_app_profile_instance_reference"]):
+        app_uuid = str(row[0])
+        if app_uuid not in app_uuids:
+            continue
+        state, profile_instance_reference = row[1]
+        if state == DELETED_STATE:
+            log.info("Application %s is in deleted state, skipping.", app_uuid)
+            deleted_uuids.add(app_uuid)
+        elif profile_instance_reference:
+            profile_instances[reference_uuid(profile_instance_reference)] = app_uuid
+    return profile_instances, deleted_uuids
+
+def scan_substrate_element_categories(profile_instance_uuids):
+    """
+    Paged IDF projection of the non deleted NutanixSubstrateElements (AHV VMs) that reads only their
+    app profile instance reference and spec categories, returns {app_profile_instance_uuid: [categories json]}
+    for the given app profile instances. Elements whose categories are not returned are left out.
+    """
+    categories_by_instance = {}
+    for row in fetch_projection(NutanixSubstrateElementProto, ["app_profile_instance_reference", "spec.categories"],
+                                deleted=False):
+        profile_instance_reference, categories = row[1]
+        instance_uuid = reference_uuid(profile_instance_reference)
+        if instance_uuid in profile_instance_uuids and categories is not None:
+            categories_by_instance.setdefault(instance_uuid, []).append(categories)
+    return categories_by_instance
+
+def collect_app_categories(app_uuid, missing_uuids):
+    """Collect categories of an application by loading the full application object"""
+    application = model.Application.get_object(app_uuid)
+    if not application:
+        log.warning("Application with UUID %s does not exist.", app_uuid)
+        missing_uuids.append(app_uuid)
+        return
+    if application.state != DELETED_STATE:
+        for dep in application.active_app_profile_instance.deployments:
+            if dep.substrate.type == NUTANIX_VM:
+                for element in dep.substrate.elements:
+                    if element.spec.categories != "":
+                        add_categories(element.spec.categories)
+    else:
+        log.info("Application %s is in deleted state, skipping.", app_uuid)
+
+def collect_categories(application_uuid_list, missing_uuids):
+    """
+    Collect categories used by VMs of the given applications into dest_categorie_map.
+    Two paged IDF projections do the discovery: applications to their active app profile instance
+    (deleted ones are skipped), then the substrate element categories of those instances. An
+    application the projections find no element categories for is walked through its deployments
+    instead, as are all applications if the projections are not available or fail.
+    """
+    deleted_uuids = set()
+    covered_uuids = set()
+    if ApplicationProto is not None and NutanixSubstrateElementProto is not None:
+        try:
+            profile_instances, deleted_uuids = get_app_profile_instances(application_uuid_list)
+            categories_by_instance = scan_substrate_element_categories(profile_instances)
+            for instance_uuid, categories_list in categories_by_instance.items():
+                covered_uuids.add(profile_instances[instance_uuid])
+                for categories in categories_list:
+                    if categories != "":
+                        add_categories(categories)
+        except Exception as e:
+            log.warning("Projection scan failed, loading full application objects: %s", e)
+            deleted_uuids = set()
+            covered_uuids = set()
+            dest_categorie_map.clear()
+    log.info("Projection scan found VM categories of %d of %d applications.", len(covered_uuids), len(application_uuid_list))
+    for idx, app_uuid in enumerate(application_uuid_list, start=1):
+        if app_uuid in covered_uuids or app_uuid in deleted_uuids:
+            continue
+        log.info("Loading application %d of %d: UUID %s", idx, len(application_uuid_list), app_uuid)
+        try:
+            collect_app_categories(app_uuid, missing_uuids)
+        except Exception as e:
+            log.warning("Could not process application UUID %s: %s", app_uuid, e)
+            missing_uuids.append(app_uuid)
+    return len(application_uuid_list)
+
+def apply_category_writes(keys, values, concurrency=CATEGORY_CONCURRENCY):
+    """
+    Create category keys and values over a bounded pool, returns number of successful writes.
+    Keys are created first; values of a key are submitted once the key exists, values of keys
+    already present on the PC are submitted right away. In batch mode values of all keys are
+    pooled into PC_BATCH_SIZE requests per batch call.
+    Args:
+        keys(list): category keys to create
+        values(list): (key, value) pairs to create
+        concurrency(int): max parallel requests
+    """
+    created = 0
+    values_by_key = {}
+    for key, value in values:
+        values_by_key.setdefault(key, []).append(value)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        value_futures = []
+        # Batch mode: (key, value) pairs of ready keys not yet sent, and (chunk, future) of sent batches
+        pending_batch = []
+        batch_futures = []
+
+        def submit_batches(flush=False):
+            while len(pending_batch) >= PC_BATCH_SIZE or (flush and pending_batch):
+                chunk = pending_batch[:PC_BATCH_SIZE]
+                del pending_batch[:PC_BATCH_SIZE]
+                batch_futures.append((chunk, executor.submit(create_category_values_batch, dest_client, chunk)))
+
+        def submit_values(key):
+            if PC_BATCH_SIZE:
+                pending_batch.extend((key, value) for value in values_by_key.get(key, []))
+                submit_batches()
+                return
+            for value in values_by_key.get(key, []):
+                value_futures.append((key, value, executor.submit(create_category_value, dest_client, key, value)))
+
+        key_futures = {}
+        for key in keys:
+            log.info("Category with key %s not present on pc, creating one", key)
+            key_futures[executor.submit(create_category_key, dest_client, key)] = key
+        for key in values_by_key:
+            if key not in keys:
+                submit_values(key)
+        for future in as_completed(key_futures):
+            key = key_futures[future]
+            try:
+                future.result()
+                created += 1
+            except Exception as e:
+                log.error("Failed to create category key %s, skipping its %d values: %s", key, len(values_by_key.get(key, [])), e)
+                continue
+            submit_values(key)
+        if PC_BATCH_SIZE:
+            submit_batches(flush=True)
+        for chunk, future in batch_futures:
+            try:
+                created += future.result()
+            except Exception as e:
+                for key, value in chunk:
+                    log.error("Failed to create category value %s for key %s: %s", value, key, e)
+        for key, value, future in value_futures:
+            try:
+                future.result()
+                created += 1
+            except Exception as e:
+                log.error("Failed to create category value %s for key %s: %s", value, key, e)
+    return created
+
 def create_categories():
     log.info("Creating categories/values")
     init_contexts()
     application_uuid_list = get_application_uuids(SOURCE_PROJECT)
     log.info("Retrieved %d application UUIDs from project '%s'", len(application_uuid_list), SOURCE_PROJECT)
     missing_uuids = []
-    processed = 0
-    for idx, app_uuid in enumerate(application_uuid_list, start=1):
-        log.info("Processing application %d of %d: UUID %s", idx, len(application_uuid_list), app_uuid)
-        processed += 1
-        try:
-            application = model.Application.get_object(app_uuid)
-            if not application:
-                log.warning("Application with UUID %s does not exist.", app_uuid)
-                missing_uuids.append(app_uuid)
-                continue
-            if application.state != DELETED_STATE:
-                for dep in application.active_app_profile_instance.deployments:
-                    if dep.substrate.type == NUTANIX_VM:
-                        for element in dep.substrate.elements:
-                            if element.spec.categories != "":
-                                category = json.loads(element.spec.categories)
-                                for key in category.keys():
-                                    value = category[key]
-                                    if key not in dest_categorie_map.keys():
-                                        dest_categorie_map[key] = []
-                                        if key not in SYS_DEFINED_CATEGORY_KEY_LIST:
-                                            if DRY_RUN:
-                                                log.info("[DRY RUN] Would create category key '%s'", key)
-                                            else:
-                                                log.info("Category with key %s not present on pc, creating one", key)
-                                                try:
-                                                    create_category_key(dest_base_url, dest_pc_auth, key)
-                                                except Exception as e:
-                                                    log.error("Failed to create category key %s: %s", key, e)
-                                    if value not in dest_categorie_map[key]:
-                                        dest_categorie_map[key].append(value)
-                                        if DRY_RUN:
-                                            log.info("[DRY RUN] Would create category value '%s' for key '%s'", value, key)
-                                        else:
-                                            log.info("Creating key: %s - value: %s", key, value)
-                                            try:
-                                                create_category_value(dest_base_url, dest_pc_auth, key, value)
-                                            except Exception as e:
-                                                log.error("Failed to create category value %s for key %s: %s", value, key, e)
-            else:
-                log.info("Application %s is in deleted state, skipping.", app_uuid)
-        except Exception as e:
-            log.warning("Could not process application UUID %s: %s", app_uuid, e)
-            missing_uuids.append(app_uuid)
-            continue
+    processed = collect_categories(application_uuid_list, missing_uuids)
     if missing_uuids:
         log.warning("The following application UUIDs could not be processed (missing or error): %s", missing_uuids)
+
+    dest_categories = get_dest_categories(dest_client, list(dest_categorie_map.keys()))
+    missing_keys = []
+    missing_values = []
+    skipped = 0
+    for key, values in dest_categorie_map.items():
+        if key in SYS_DEFINED_CATEGORY_KEY_LIST:
+            pass
+        elif key in dest_categories:
+            skipped += 1
+        else:
+            missing_keys.append(key)
+        for value in values:
+            if value in dest_categories.get(key, ()):
+                skipped += 1
+            else:
+                missing_values.append((key, value))
+    log.info("Creating %d category keys and %d values with concurrency %d", len(missing_keys), len(missing_values), CATEGORY_CONCURRENCY)
+    created = apply_category_writes(missing_keys, missing_values)
+    log.info("Category sync: %d writes issued, %d skipped as already present on pc", created, skipped)
     log.info("Done with creating categories and values")
-    return processed
+    return processed, created, skipped
 
 def print_header():
     print("="*60)
@@ -206,7 +396,7 @@ def main():
     try:
         print_header()
         #create_categories()
-        processed = create_categories()
+        processed, created, skipped = create_categories()
     except Exception as e:
         log.error("Exception: %s", e)
         raise
@@ -216,6 +406,8 @@ def main():
     print(f"  Start time: {start_time}")
     print(f"  End time:   {end_time}")
     print(f"  Total Apps processed:    {processed}")
+    print(f"  Category writes issued:  {created}")
+    print(f"  Category writes skipped: {skipped}")
     print("="*60)
 
 if __name__ == '__main__':